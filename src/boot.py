@@ -0,0 +1,60 @@
+# Selects the installed version before main.py runs. The updater installs a release
+# into the inactive slot and points boot.json at it. MicroPython runs main.py from the
+# current folder, so changing into the slot folder boots that version. State that has
+# to survive a slot switch (RTC drift, WLAN cache) is kept at absolute root paths.
+import os, json
+
+BOOT_STATE_PATH = "/boot.json"
+# A new version that did not confirm itself within this many boots is rolled back
+MAX_BOOT_ATTEMPTS = 3
+
+def load_state():
+    try:
+        with open(BOOT_STATE_PATH, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    with open(BOOT_STATE_PATH + ".tmp", "w") as f:
+        json.dump(state, f)
+    os.rename(BOOT_STATE_PATH + ".tmp", BOOT_STATE_PATH)
+
+def read_version(slot):
+    try:
+        with open(slot + "/version", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def select_slot():
+    state = load_state()
+    if state.get("pending"):
+        state["attempts"] = state.get("attempts", 0) + 1
+        if state["attempts"] > MAX_BOOT_ATTEMPTS:
+            print("Update failed health checks, rolling back")
+            state = {
+                "active": state.get("previous") or "",
+                "previous": state.get("active"),
+                "pending": False,
+                "failed_version": read_version(state.get("active"))
+            }
+        save_state(state)
+    return state
+
+state = select_slot()
+slot = state.get("active") or ""
+if slot:
+    try:
+        os.chdir(slot)
+    except OSError as e:
+        print(e)
+
+# "import_report": true in boot.json prints the import time and heap of every module
+# of the booted version, before main.py imports anything
+if state.get("import_report"):
+    try:
+        import importtimes
+        importtimes.report()
+    except Exception as e:
+        print(e)
@@ -0,0 +1,108 @@
+"""
+Minimal non-blocking HTTP(S) GET client for uasyncio.
+
+Mirrors the parts of urequests used by the managers (status_code, headers,
+json(), close()) so a manager can share its parsing code between the
+blocking and the asynchronous fetch path.
+
+Example usage:
+
+    import uasyncio as asyncio
+    from drivers import arequests
+
+    async def fetch():
+        response = await arequests.get("https://api.brightsky.dev/current_weather?lat=52.5&lon=13.4")
+        data = response.json()
+        response.close()
+
+    asyncio.run(fetch())
+
+"""
+
+import json
+import uasyncio as asyncio
+
+
+class Response:
+    def __init__(self, status_code, reason, headers, content):
+        self.status_code = status_code
+        self.reason = reason
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return str(self.content, "utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def close(self):
+        self.content = None
+
+
+def _split_url(url):
+    proto, _, rest = url.split("/", 2)
+    if proto == "https:":
+        port = 443
+    elif proto == "http:":
+        port = 80
+    else:
+        raise ValueError("Unsupported protocol: " + proto)
+
+    if "/" in rest:
+        host, path = rest.split("/", 1)
+        path = "/" + path
+    else:
+        host, path = rest, "/"
+
+    if ":" in host:
+        host, port = host.split(":", 1)
+        port = int(port)
+
+    return proto == "https:", host, port, path
+
+
+async def request(method, url, headers=None, timeout=15):
+    """Send a request and read the whole response.
+
+    HTTP/1.0 is used so the server closes the connection after the body and
+    no chunked transfer decoding is necessary.
+    """
+    use_ssl, host, port, path = _split_url(url)
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port, ssl=True if use_ssl else None), timeout
+    )
+    try:
+        lines = [f"{method} {path} HTTP/1.0", f"Host: {host}", "Connection: close"]
+        if headers:
+            for key, value in headers.items():
+                lines.append(f"{key}: {value}")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode())
+        await writer.drain()
+
+        status_line = await asyncio.wait_for(reader.readline(), timeout)
+        parts = status_line.decode().split(None, 2)
+        if len(parts) < 2:
+            raise OSError("Invalid HTTP response")
+        status_code = int(parts[1])
+        reason = parts[2].rstrip() if len(parts) > 2 else ""
+
+        response_headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line or line == b"\r\n":
+                break
+            key, _, value = line.decode().partition(":")
+            response_headers[key.strip()] = value.strip()
+
+        content = await asyncio.wait_for(reader.read(-1), timeout)
+        return Response(status_code, reason, response_headers, content)
+
+    finally:
+        writer.close()
+        await writer.wait_closed()
+
+
+async def get(url, headers=None, timeout=15):
+    return await request("GET", url, headers, timeout)
@@ -0,0 +1,73 @@
+"""
+Boot-time import report to measure what precompiled .mpy modules save.
+
+boot.py runs it after a reset, before main.py imports anything, if boot.json
+contains "import_report": true. It can also be run by hand right after a reset:
+
+    import importtimes
+    importtimes.report()
+
+Modules are imported in dependency order (hashdata, drivers, managers), so
+each line only counts the module itself. "heap" is the heap taken while
+importing, including the transient garbage of compiling source; "kept" is
+what remains after a collection. The total line sums the time and the kept
+heap and shows the largest heap spike.
+"""
+
+import gc, os, sys, time
+
+PACKAGES = ("drivers", "managers")
+
+
+def find_modules():
+    modules = ["hashdata"]
+    for package in PACKAGES:
+        names = set()
+        for entry in os.listdir(package):
+            name, _, extension = entry.rpartition(".")
+            if extension in ("py", "mpy") and name != "__init__":
+                names.add(name)
+        modules.extend(package + "." + name for name in sorted(names))
+    return modules
+
+
+def get_format(module):
+    path = module.replace(".", "/")
+    try:
+        os.stat(path + ".mpy")
+        return "mpy"
+    except OSError:
+        return "py"
+
+
+def time_import(module):
+    gc.collect()
+    free = gc.mem_free()
+    start = time.ticks_ms()
+    __import__(module)
+    elapsed = time.ticks_diff(time.ticks_ms(), start)
+    heap = free - gc.mem_free()
+    gc.collect()
+    return elapsed, heap, free - gc.mem_free()
+
+
+def report(modules=None):
+    """Imports every module that is not loaded yet and prints one line per module."""
+    rows = []
+    for module in modules or find_modules():
+        if module in sys.modules:
+            continue
+        try:
+            elapsed, heap, kept = time_import(module)
+        except Exception as e:
+            print(module, "failed:", e)
+            continue
+        rows.append((module, get_format(module), elapsed, heap, kept))
+
+    print("{:<32} {:>4} {:>7} {:>8} {:>8}".format("module", "fmt", "ms", "heap", "kept"))
+    for row in rows:
+        print("{:<32} {:>4} {:>7} {:>8} {:>8}".format(*row))
+    print("{:<32} {:>4} {:>7} {:>8} {:>8}".format(
+        "total", "", sum(r[2] for r in rows), max((r[3] for r in rows), default=0), sum(r[4] for r in rows)
+    ))
+    return rows
@@ -1,45 +1,134 @@
-import os, machine, network, time, shutil
-from updater import UpdateManager
+import machine, json
 
-SSID = 'Wlan-Name'
-PASSWORD = 'Wlan-Password'
+BOOT_STATE_PATH = "/boot.json"
+# Seconds between two looks at UpdateManager.check_due()
+UPDATE_POLL_INTERVAL = 3600
+# An unconfirmed version that stops feeding the watchdog this long is reset
+WATCHDOG_TIMEOUT_MS = 300000
+WATCHDOG_FEED_INTERVAL = 10
 
-upmr = UpdateManager()
+def update_pending():
+    # Read without the updater, which may be the part of the new version that fails
+    try:
+        with open(BOOT_STATE_PATH, "r") as f:
+            return bool(json.load(f).get("pending"))
+    except (OSError, ValueError):
+        return False
+
+def fail(e):
+    # Resetting counts as a failed boot, so a broken update is rolled back
+    print(e)
+    if update_pending():
+        machine.reset()
+    raise e
+
+# A hung boot never reaches an exception handler, the watchdog resets it instead.
+# Once started it cannot be stopped, so it is fed for as long as the version runs.
+watchdog = machine.WDT(timeout=WATCHDOG_TIMEOUT_MS) if update_pending() else None
+
+try:
+    import uasyncio as asyncio
+    from updater import UpdateManager
+    from managers.ScheduleManager import ScheduleManager
+    from managers.StartupManager import StartupManager
 
-def connect_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if not wlan.isconnected():
-        wlan.connect(SSID, PASSWORD)
-        while not wlan.isconnected():
-            time.sleep(1)
-    print('Connected to WiFi')
+    upmr = UpdateManager()
+    startup = StartupManager()
+except Exception as e:
+    fail(e)
 
-def main():
+def shutdown():
+    # The price history is written in batches, a reset would drop the open one
     try:
-        shutil.rmtree("updates")
-    except OSError:
-        pass
+        if startup.refresh_manager is not None:
+            startup.refresh_manager.shutdown()
+    except Exception as e:
+        print(e)
+
+async def check_update():
+    # A freshly installed version checks right away to confirm itself
+    if not upmr.check_due() and not upmr.update_pending():
+        return
 
-    print("This program does B!")
     current_version, update_version = upmr.update_available()
+    # Reaching the release server proves that this version works; it is kept from now on
+    if current_version is not None:
+        upmr.confirm_update()
+
     if current_version != update_version:
         print("Update found!")
         print("Current version:", current_version)
         print("Update version:", update_version)
         print("Downloading update...")
-        error_code, error_msg = upmr.download_update()
-        if error_code is not "OK":
+        # The download and the staging yield between chunks, so the display keeps running
+        error_code, error_msg = await upmr.download_update_async()
+        if error_code != "OK":
+            # The partial download is resumed by the next check
             print(error_msg)
-            machine.reset()
-        
-        upmr.verify_update()
-        os.rename("main.py", "main_OLD.py")
-        os.rename("updater.py", "main.py")
-        machine.reset()
+            return
+
+        await upmr.install_update_async(shutdown)
 
     else:
         print("Everything is up-to-date!")
 
+async def run_updates():
+    while True:
+        try:
+            await check_update()
+        except Exception as e:
+            print(e)
+        await asyncio.sleep(UPDATE_POLL_INTERVAL)
+
+def draw_error(error_code, error_text):
+    sd = startup.sd_card_manager
+    startup.display_manager.draw_error(error_code, error_text, sd.get_error_qr_code(error_code))
+
+def create_schedule(run_now):
+    refresh_manager = startup.refresh_manager
+    intervals = startup.sd_card_manager.properties.get("refresh_intervals") or {}
+    schedule = ScheduleManager(intervals)
+    schedule.add("prices", lambda: refresh_manager.refresh(sync_time=False, weather=False), run_now=run_now)
+    schedule.add("forecast", lambda: refresh_manager.refresh(sync_time=False, stations=False), run_now=run_now)
+    # Unless configured, NTP follows the spacing the measured RTC drift allows. Without
+    # jitter the task never wakes up before TimeManager.sync_due() agrees.
+    if "ntp" in intervals:
+        schedule.add("ntp", lambda: refresh_manager.refresh(weather=False, stations=False), run_now=run_now)
+    else:
+        schedule.add("ntp", lambda: refresh_manager.refresh(weather=False, stations=False), run_now=run_now,
+                     jitter=0, interval=startup.time_manager.get_sync_interval)
+    return schedule
+
+async def feed_watchdog():
+    while True:
+        watchdog.feed()
+        await asyncio.sleep(WATCHDOG_FEED_INTERVAL)
+
+async def main():
+    if watchdog is not None:
+        asyncio.create_task(feed_watchdog())
+    error_code, error_text = await startup.start()
+    refresh_manager = startup.refresh_manager
+    if refresh_manager is None:
+        draw_error(error_code, error_text)
+        # A new version that cannot start is rolled back instead of confirmed
+        if update_pending():
+            machine.reset()
+        # Otherwise the setup is broken and only an update can still help
+    else:
+        if error_code != "OK":
+            # The data of the last run stays on the display while the schedule retries
+            print(error_code, error_text)
+        asyncio.create_task(refresh_manager.run_clock())
+        asyncio.create_task(refresh_manager.run_pages())
+        # The first refresh already fetched every source unless it failed
+        asyncio.create_task(create_schedule(error_code != "OK").run())
+
+    await run_updates()
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except Exception as e:
+        shutdown()
+        fail(e)
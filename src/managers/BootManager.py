@@ -0,0 +1,86 @@
+import gc, os, json, time
+
+class BootManager:
+    """
+    Records the boot timeline: start and end of every stage in ticks_ms and the free
+    heap before and after it. On the ESP32 ticks_ms counts from the reset, so the
+    times include the firmware start, boot.py and the imports. Stages may overlap,
+    events (e.g. "first_price") are stages without a duration.
+    """
+
+    def __init__(self, path="/sd/boot_timeline.json", keep=10):
+        self.path = path
+        # Number of boots kept in the file to compare changes against earlier boots
+        self.keep = keep
+        self.stages = []
+        self.__open = {}
+
+    def start(self, stage):
+        self.__open[stage] = len(self.stages)
+        self.stages.append([stage, time.ticks_ms(), None, gc.mem_free(), None])
+
+    def stop(self, stage):
+        index = self.__open.pop(stage, None)
+        if index is not None:
+            self.stages[index][2] = time.ticks_ms()
+            self.stages[index][4] = gc.mem_free()
+
+    def mark(self, event):
+        """Records an event once, later calls with the same name are ignored."""
+        if any(entry[0] == event for entry in self.stages):
+            return
+        ticks = time.ticks_ms()
+        free = gc.mem_free()
+        self.stages.append([event, ticks, ticks, free, free])
+
+    def run(self, stage, function, *args):
+        self.start(stage)
+        try:
+            return function(*args)
+        finally:
+            self.stop(stage)
+
+    async def run_async(self, stage, coroutine):
+        self.start(stage)
+        try:
+            return await coroutine
+        finally:
+            self.stop(stage)
+
+    def get(self, stage):
+        """Returns the end of a stage (or the time of an event) in ms after the reset, None if not reached."""
+        for entry in self.stages:
+            if entry[0] == stage:
+                return entry[2]
+        return None
+
+    def report(self):
+        print("{:<16} {:>7} {:>7} {:>7} {:>8} {:>8}".format("stage", "start", "end", "ms", "heap", "free"))
+        for stage, start, end, before, after in self.stages:
+            if end is None:
+                print("{:<16} {:>7} {:>7} {:>7} {:>8} {:>8}".format(stage, start, "-", "-", "-", before))
+            else:
+                print("{:<16} {:>7} {:>7} {:>7} {:>8} {:>8}".format(
+                    stage, start, end, time.ticks_diff(end, start), before - after, after
+                ))
+
+    def save(self):
+        try:
+            with open(self.path, "r") as f:
+                boots = json.load(f)
+        except Exception:
+            boots = []
+        boots.append(self.stages)
+
+        try:
+            with open(self.path + ".tmp", "w") as f:
+                json.dump(boots[-self.keep:], f)
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            os.rename(self.path + ".tmp", self.path)
+            return True
+        except Exception as e:
+            print(e)
+            return False
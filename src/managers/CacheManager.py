@@ -0,0 +1,60 @@
+import os, json
+
+class CacheManager:
+    def __init__(self, directory="/sd/cache"):
+        self.directory = directory
+        self.__directory_ready = False
+
+    def __ensure_directory(self):
+        if self.__directory_ready:
+            return
+
+        path = ""
+        for part in self.directory.split("/"):
+            if not part:
+                continue
+            path += "/" + part
+            try:
+                os.mkdir(path)
+            except OSError:
+                pass
+        self.__directory_ready = True
+
+    def __path(self, key):
+        return f"{self.directory}/{key}.json"
+
+    def load(self, key):
+        try:
+            with open(self.__path(key), "r") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def save(self, key, entry):
+        try:
+            self.__ensure_directory()
+            path = self.__path(key)
+            with open(path + ".tmp", "w") as f:
+                json.dump(entry, f)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.rename(path + ".tmp", path)
+            return True
+        except Exception as e:
+            print(e)
+            return False
+
+    def remove(self, key):
+        try:
+            os.remove(self.__path(key))
+        except OSError:
+            pass
+
+    def keys(self, prefix=""):
+        try:
+            files = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [f[:-5] for f in files if f.startswith(prefix) and f.endswith(".json")]
@@ -0,0 +1,90 @@
+import time
+from managers.HealthManager import reported_get, reported_get_async
+
+class DiscoveryManager:
+    # Tankerkoenig list.php accepts radii of up to 25 km
+    MAX_RADIUS = 25
+
+    def __init__(self, lat, long, radius, api_key, cache=None, ttl=86400, retry_interval=3600, max_stations=20,
+                 health=None):
+        self.base_url_station_list = (
+            f"https://creativecommons.tankerkoenig.de/json/list.php?lat={lat}&lng={long}"
+            f"&rad={radius}&sort=dist&type=all&apikey={api_key}"
+        )
+        self.cache = cache
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.max_stations = max_stations
+        self.health = health
+        self.__cache_key = "stations_{}_{}_{}".format(
+            "{:.4f}".format(lat).replace(".", "_"), "{:.4f}".format(long).replace(".", "_"), radius
+        )
+        self.__entry = None
+        self.__failed_at = None
+
+    def __get_age(self, entry):
+        age = time.time() - entry.get("fetched", 0)
+        # Before the first NTP sync the RTC can lag behind the stored fetch time
+        return age if age >= 0 else None
+
+    def __load(self):
+        if self.__entry is None and self.cache is not None:
+            self.__entry = self.cache.load(self.__cache_key)
+        return self.__entry
+
+    def __discovery_due(self, entry):
+        if self.__failed_at is not None and 0 <= time.time() - self.__failed_at < self.retry_interval:
+            return False
+        if entry is None:
+            return True
+        age = self.__get_age(entry)
+        # Without a synced clock the cached list is used rather than spending a request
+        return age is not None and age >= self.ttl
+
+    def __read_station_list(self, response):
+        data = response.json()
+        response.close()
+        if not data.get("ok"):
+            raise OSError(data.get("message", "Station discovery failed"))
+
+        stations = []
+        for station in data["stations"][:self.max_stations]:
+            stations.append({
+                "id": station["id"],
+                "name": station.get("name") or "",
+                "brand": station.get("brand") or "",
+                "place": station.get("place") or "",
+                "dist": station.get("dist")
+            })
+
+        self.__failed_at = None
+        self.__entry = {"fetched": time.time(), "data": stations}
+        if self.cache is not None:
+            self.cache.save(self.__cache_key, self.__entry)
+
+    def get_stations(self):
+        """
+        Returns the metadata (id, name, brand, place, dist) of the stations in the
+        configured radius, nearest first. list.php is only called when the cached
+        list is older than the TTL; a failed discovery keeps the previous list.
+        """
+        entry = self.__load()
+        if self.__discovery_due(entry):
+            try:
+                self.__read_station_list(reported_get(self.health, self.base_url_station_list))
+            except Exception as e:
+                print(e)
+                self.__failed_at = time.time()
+
+        return self.__entry["data"] if self.__entry is not None else []
+
+    async def get_stations_async(self):
+        entry = self.__load()
+        if self.__discovery_due(entry):
+            try:
+                self.__read_station_list(await reported_get_async(self.health, self.base_url_station_list))
+            except Exception as e:
+                print(e)
+                self.__failed_at = time.time()
+
+        return self.__entry["data"] if self.__entry is not None else []
@@ -1,9 +1,25 @@
 from machine import Pin, SPI
 from drivers.ILI9488 import ILI9488, RGB
+from array import array
 import time
 
 class DisplayManager:
     __ERROR_SCREEN_TIMEOUT = 20
+    __STATIONS_PER_PAGE = 3
+    __PRICE_PANEL_COLOR = RGB(140, 240, 140)
+    __PAGE_DOT_COLOR = RGB(190, 190, 190)
+    # Prices restored from the last run are drawn in grey until fresh prices arrive
+    __STALE_PRICE_COLOR = RGB(110, 110, 110)
+    __STALE_TEXT_COLOR = RGB(255, 150, 0)
+
+    # Price trend sparkline next to the status text: one column per 20 minutes, 24 hours wide
+    __TREND_X = 252
+    __TREND_Y = 133
+    __TREND_WIDTH = 72
+    __TREND_HEIGHT = 20
+    __TREND_COLUMN_SECONDS = 86400 // 72
+    __TREND_COLOR = RGB(0, 150, 0)
+    __TREND_CURSOR_COLOR = RGB(220, 220, 220)
 
     __STATION_DEFAULT_TEXT_LABELS = [
         "First Gas Station",
@@ -34,6 +50,22 @@ class DisplayManager:
         }
         self.ili_font = ili_font
         self.price_font = price_font
+        # Icons, labels and the latest data of every station are kept in RAM, so
+        # switching pages only writes to the display and never touches SD or network
+        self.station_page = 0
+        self.__station_icons = []
+        self.__station_labels = []
+        self.__fuel_type = None
+        self.__station_statuses = []
+        self.__fuel_prices = []
+        self.__stale = False
+        # Per station: price ring buffer in tenths of a cent (0 = no data), the time slot
+        # of the newest column and the price range the sparkline is currently scaled to
+        self.__trends = []
+        self.__trend_slots = []
+        self.__trend_ranges = []
+        self.__trend_column = bytearray(3 * self.__TREND_HEIGHT)
+        self.__trend_background = bytearray(b"\xff" * (3 * self.__TREND_HEIGHT))
         self.clear_display()    
 
     def __ljust(self, s, width, fillchar = ' '):
@@ -94,17 +126,213 @@ class DisplayManager:
         self.display.image(199, 44, 34, 34, weather_symbols[2])
         self.display.image(297, 43, 34, 34, weather_symbols[3])
 
-        for i in range(3):
-            self.display.image(8, 88 + 80 * i, 64, 64, station_icons[i])
-            self.display.fill_rect(332, 82 + 80 * i, 148, 78, RGB(140, 240, 140))
-            if station_labels[i][1] == "":
-                self.display.text(90, 89 + 80 * i, self.__STATION_DEFAULT_TEXT_LABELS(i), ILI9488.BLACK, 1, ILI9488.WHITE)
-            else:
-                self.display.text(90, 89 + 80 * i,  station_labels[i][1][:21], ILI9488.BLACK, 1, ILI9488.WHITE)
-            if station_labels[i][2] == "":
-                self.display.text(90, 89 + 80 * i + 22, self.__STATION_DEFAULT_FUEL_LABELS.get(fuel_type), ILI9488.BLACK, 1, ILI9488.WHITE)
+        self.__station_icons = station_icons
+        self.__station_labels = station_labels
+        self.__fuel_type = fuel_type
+        self.__station_statuses = [None] * len(station_icons)
+        self.__fuel_prices = [None] * len(station_icons)
+        self.__reset_trends(len(station_icons))
+        self.station_page = 0
+        self.__draw_station_page()
+
+    def set_stations(self, station_icons, station_labels):
+        self.__station_icons = station_icons
+        self.__station_labels = station_labels
+        self.__station_statuses = [None] * len(station_icons)
+        self.__fuel_prices = [None] * len(station_icons)
+        self.__reset_trends(len(station_icons))
+        if self.station_page >= self.get_station_page_count():
+            self.station_page = 0
+        self.__draw_station_page()
+
+    def get_station_page_count(self):
+        return max(1, (len(self.__station_icons) + self.__STATIONS_PER_PAGE - 1) // self.__STATIONS_PER_PAGE)
+
+    def show_next_station_page(self):
+        page_count = self.get_station_page_count()
+        if page_count > 1:
+            self.station_page = (self.station_page + 1) % page_count
+            self.__draw_station_page()
+
+    def __get_station_label(self, i):
+        label = self.__station_labels[i][1]
+        if label != "":
+            return label[:21]
+        if i < len(self.__STATION_DEFAULT_TEXT_LABELS):
+            return self.__STATION_DEFAULT_TEXT_LABELS[i]
+        return f"Gas Station {i + 1}"
+
+    def __draw_station_page(self):
+        first = self.station_page * self.__STATIONS_PER_PAGE
+        for row in range(self.__STATIONS_PER_PAGE):
+            i = first + row
+            self.currently_displayed["station_statuses"][row] = None
+            self.currently_displayed["fuel_prices"][row] = None
+            self.display.fill_rect(0, 82 + 80 * row, 330, 78, ILI9488.WHITE)
+            if i >= len(self.__station_icons):
+                self.display.fill_rect(332, 82 + 80 * row, 148, 78, ILI9488.WHITE)
+                continue
+
+            self.display.image(8, 88 + 80 * row, 64, 64, self.__station_icons[i])
+            self.display.fill_rect(332, 82 + 80 * row, 148, 78, self.__PRICE_PANEL_COLOR)
+            self.display.text(90, 89 + 80 * row, self.__get_station_label(i), ILI9488.BLACK, 1, ILI9488.WHITE)
+            if self.__station_labels[i][2] == "":
+                self.display.text(90, 89 + 80 * row + 22, self.__STATION_DEFAULT_FUEL_LABELS.get(self.__fuel_type), ILI9488.BLACK, 1, ILI9488.WHITE)
             else:
-                self.display.text(90, 89 + 80 * i + 22,  station_labels[i][2][:21], ILI9488.BLACK, 1, ILI9488.WHITE)
+                self.display.text(90, 89 + 80 * row + 22,  self.__station_labels[i][2][:21], ILI9488.BLACK, 1, ILI9488.WHITE)
+            self.__draw_station_row(row, i)
+            self.__draw_trend(row, i)
+
+        page_count = self.get_station_page_count()
+        if page_count > 1:
+            for page in range(page_count):
+                color = ILI9488.BLACK if page == self.station_page else self.__PAGE_DOT_COLOR
+                self.display.fill_rect(90 + 8 * page, 315, 4, 3, color)
+
+    def __reset_trends(self, station_count):
+        self.__trends = [array("H", [0] * self.__TREND_WIDTH) for _ in range(station_count)]
+        self.__trend_slots = [None] * station_count
+        self.__trend_ranges = [None] * station_count
+
+    def __get_trend_row(self, i):
+        first = self.station_page * self.__STATIONS_PER_PAGE
+        return i - first if first <= i < first + self.__STATIONS_PER_PAGE else None
+
+    def __scale_trend(self, i):
+        values = [v for v in self.__trends[i] if v]
+        if not values:
+            self.__trend_ranges[i] = None
+            return
+        # Some headroom keeps small moves from forcing a full rescale and repaint
+        low, high = min(values), max(values)
+        padding = max(5, (high - low) // 4)
+        self.__trend_ranges[i] = (max(0, low - padding), high + padding)
+
+    def __get_trend_y(self, i, value):
+        low, high = self.__trend_ranges[i]
+        return (self.__TREND_HEIGHT - 1) - (value - low) * (self.__TREND_HEIGHT - 1) // (high - low)
+
+    def __get_cursor_column(self, i):
+        slot = self.__trend_slots[i]
+        return None if slot is None else (slot + 1) % self.__TREND_WIDTH
+
+    def __draw_trend_column(self, row, i, column):
+        trend = self.__trends[i]
+        buf = self.__trend_column
+        cursor = self.__get_cursor_column(i)
+        if column == cursor:
+            # The sweep cursor right of the newest column clears the oldest sample
+            r, g, b = self.__TREND_CURSOR_COLOR
+            for j in range(0, len(buf), 3):
+                buf[j], buf[j + 1], buf[j + 2] = r, g, b
+        else:
+            buf[:] = self.__trend_background
+            value = trend[column]
+            if value and self.__trend_ranges[i] is not None:
+                y = self.__get_trend_y(i, value)
+                # The column right of the cursor has no predecessor on the screen
+                previous = trend[column - 1] if (column - 1) % self.__TREND_WIDTH != cursor else 0
+                previous_y = self.__get_trend_y(i, previous) if previous else y
+                r, g, b = self.__TREND_COLOR
+                # The step from the previous column is one vertical run in this column
+                for j in range(3 * min(y, previous_y), 3 * max(y, previous_y) + 3, 3):
+                    buf[j], buf[j + 1], buf[j + 2] = r, g, b
+
+        # Columns stay at their ring position and the cursor sweeps from left to right,
+        # so a new slot only draws its own column and moves the cursor
+        x = self.__TREND_X + column
+        y0 = self.__TREND_Y + 80 * row
+        self.display.set_window(x, y0, x, y0 + self.__TREND_HEIGHT - 1)
+        self.display.write_data(buf)
+
+    def __draw_trend(self, row, i):
+        for column in range(self.__TREND_WIDTH):
+            self.__draw_trend_column(row, i, column)
+
+    def load_price_trend(self, i, entries):
+        """Fills the sparkline of station i from (timestamp, price, status) entries, oldest first."""
+        trend = self.__trends[i]
+        for column in range(self.__TREND_WIDTH):
+            trend[column] = 0
+        self.__trend_slots[i] = None
+        for timestamp, price, _ in entries:
+            self.__add_trend_value(i, timestamp, price)
+        self.__scale_trend(i)
+        row = self.__get_trend_row(i)
+        if row is not None:
+            self.__draw_trend(row, i)
+
+    def __add_trend_value(self, i, timestamp, price):
+        trend = self.__trends[i]
+        slot = timestamp // self.__TREND_COLUMN_SECONDS
+        last_slot = self.__trend_slots[i]
+        value = int(price * 1000 + .5) if price is not None else 0
+        if last_slot is None or slot - last_slot >= self.__TREND_WIDTH:
+            for column in range(self.__TREND_WIDTH):
+                trend[column] = 0
+            new_columns = [slot % self.__TREND_WIDTH]
+        elif slot <= last_slot:
+            new_columns = []
+            slot = last_slot
+        else:
+            # Columns of slots without a sample repeat the previous price
+            previous = trend[last_slot % self.__TREND_WIDTH]
+            new_columns = []
+            for skipped in range(last_slot + 1, slot):
+                trend[skipped % self.__TREND_WIDTH] = previous
+                new_columns.append(skipped % self.__TREND_WIDTH)
+            new_columns.append(slot % self.__TREND_WIDTH)
+
+        trend[slot % self.__TREND_WIDTH] = value
+        self.__trend_slots[i] = slot
+        return new_columns
+
+    def draw_price_trend(self, i, timestamp, price):
+        """
+        Adds the current price of station i. Only the newest column is redrawn, and
+        when a new 20 minute slot starts also the skipped columns and the cursor. The
+        whole sparkline is repainted only when the price leaves the current scale.
+        """
+        last_slot = self.__trend_slots[i]
+        new_columns = self.__add_trend_value(i, timestamp, price)
+        value = self.__trends[i][self.__trend_slots[i] % self.__TREND_WIDTH]
+        trend_range = self.__trend_ranges[i]
+        full_redraw = trend_range is None or (value and not trend_range[0] <= value <= trend_range[1])
+        if full_redraw or (last_slot is not None and self.__trend_slots[i] - last_slot >= self.__TREND_WIDTH):
+            self.__scale_trend(i)
+            full_redraw = True
+
+        row = self.__get_trend_row(i)
+        if row is None:
+            return
+        if full_redraw:
+            self.__draw_trend(row, i)
+            return
+
+        newest = self.__trend_slots[i] % self.__TREND_WIDTH
+        if newest not in new_columns:
+            new_columns.append(newest)
+        if last_slot != self.__trend_slots[i]:
+            # The cursor clears the oldest column and the next one loses its step from it
+            cursor = self.__get_cursor_column(i)
+            new_columns.append(cursor)
+            new_columns.append((cursor + 1) % self.__TREND_WIDTH)
+        for column in new_columns:
+            self.__draw_trend_column(row, i, column)
+
+    def __draw_station_row(self, row, i):
+        status = self.__station_statuses[i]
+        if status is not None and status != self.currently_displayed.get("station_statuses")[row]:
+            self.currently_displayed["station_statuses"][row] = status
+            self.display.text(90, 133 + 80 * row, self.__ljust(status, 14), self.__STATION_STATUS_COLOR.get(status), 1, ILI9488.WHITE)
+
+        fuel_price = self.__fuel_prices[i]
+        if fuel_price is not None and fuel_price != self.currently_displayed.get("fuel_prices")[row]:
+            self.currently_displayed["fuel_prices"][row] = fuel_price
+            self.display.set_font(self.price_font)
+            color = self.__STALE_PRICE_COLOR if self.__stale else ILI9488.BLACK
+            self.display.text(343, 91 + 80 * row, fuel_price, color, 2, self.__PRICE_PANEL_COLOR, 6)
+            self.display.set_font(self.ili_font)
     
     def draw_weekday_date_time(self, timedate):
         if timedate[0] != self.currently_displayed.get("timedate")[0]:
@@ -132,17 +360,33 @@ class DisplayManager:
             self.currently_displayed["weather_icon_name"] = weather_icon_name
             self.display.image(400, 0, 80, 80, weather_icon)
     
-    def draw_station_data(self, station_statuses, fuel_prices):
+    def draw_data_age(self, age):
+        """
+        Shows how old the restored data is (in seconds, None if unknown) in the
+        weekday field. The next clock update draws over it.
+        """
+        if age is None:
+            text = "CACHED"
+        elif age < 3600:
+            text = f"{age // 60} MIN AGO"
+        elif age < 86400:
+            text = f"{age // 3600} H AGO"
+        else:
+            text = f"{age // 86400} D AGO"
+        self.currently_displayed["timedate"][0] = None
+        text_length = self.ili_font.measure_text(text)
+        self.display.fill_rect(0, 0, 142, 39, ILI9488.WHITE)
+        self.display.text(23 + (98 - text_length) // 2, 11, text, self.__STALE_TEXT_COLOR, 1, ILI9488.WHITE)
+
+    def draw_station_data(self, station_statuses, fuel_prices, stale=False):
+        # Rows are only written to the display where the status or price changed
+        if stale != self.__stale:
+            # Every visible price is redrawn in the color of the new state
+            self.__stale = stale
+            self.currently_displayed["fuel_prices"] = [None] * self.__STATIONS_PER_PAGE
+        first = self.station_page * self.__STATIONS_PER_PAGE
         for i in range(len(station_statuses)):
-            if station_statuses[i] != self.currently_displayed.get("station_statuses")[i]:
-                self.currently_displayed["station_statuses"][i] = station_statuses[i]
-                status = station_statuses[i]
-                self.display.text(90, 133 + 80 * i, self.__ljust(status, 14), self.__STATION_STATUS_COLOR.get(status), 1, ILI9488.WHITE)
-        
-        self.display.set_font(self.price_font)
-        for i in range(len(fuel_prices)):
-            if fuel_prices[i] != self.currently_displayed.get("fuel_prices")[i]:
-                self.currently_displayed["fuel_prices"][i] = fuel_prices[i]
-                self.display.text(343, 91 + 80 * i, fuel_prices[i], ILI9488.BLACK, 2, RGB(140, 240, 140), 6)
-        
-        self.display.set_font(self.ili_font)
\ No newline at end of file
+            self.__station_statuses[i] = station_statuses[i]
+            self.__fuel_prices[i] = fuel_prices[i]
+            if first <= i < first + self.__STATIONS_PER_PAGE:
+                self.__draw_station_row(i - first, i)
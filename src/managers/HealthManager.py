@@ -0,0 +1,97 @@
+import socket, time
+import urequests as requests
+import uasyncio as asyncio
+from drivers import arequests
+
+def reported_get(health, url, headers=None):
+    """requests.get() that passes the outcome on to an optional HealthManager."""
+    try:
+        response = requests.get(url, headers=headers or {})
+    except OSError:
+        if health is not None:
+            health.report(False)
+        raise
+    if health is not None:
+        health.report(True)
+    return response
+
+async def reported_get_async(health, url, headers=None):
+    try:
+        response = await arequests.get(url, headers=headers)
+    except (OSError, asyncio.TimeoutError):
+        # A timeout is the usual way a dead link shows up in arequests
+        if health is not None:
+            health.report(False)
+        raise
+    if health is not None:
+        health.report(True)
+    return response
+
+class HealthManager:
+    """
+    Keeps the last connectivity verdict so callers get an answer without a network
+    round trip. The verdict comes from real API requests (report()) and, when it has
+    expired, from a rate-limited TCP probe whose socket is always closed.
+    """
+
+    def __init__(self, probe_host="1.1.1.1", probe_port=53, online_ttl_ms=60000, offline_ttl_ms=10000,
+                 min_probe_interval_ms=5000, probe_timeout=2):
+        self.probe_host = probe_host
+        self.probe_port = probe_port
+        self.online_ttl_ms = online_ttl_ms
+        self.offline_ttl_ms = offline_ttl_ms
+        self.min_probe_interval_ms = min_probe_interval_ms
+        self.probe_timeout = probe_timeout
+        self.__probe_addr = None
+        self.__online = None
+        self.__verdict_ticks = None
+        self.__probe_ticks = None
+
+    def report(self, success):
+        """Records the outcome of a real request: True if the server answered, False on a network error."""
+        self.__online = bool(success)
+        self.__verdict_ticks = time.ticks_ms()
+
+    def invalidate(self):
+        self.__online = None
+        self.__verdict_ticks = None
+
+    def get_verdict(self):
+        """Returns the cached verdict (True, False or None if unknown or expired) without any I/O."""
+        if self.__verdict_ticks is None:
+            return None
+        ttl = self.online_ttl_ms if self.__online else self.offline_ttl_ms
+        if time.ticks_diff(time.ticks_ms(), self.__verdict_ticks) >= ttl:
+            return None
+        return self.__online
+
+    def __probe(self):
+        self.__probe_ticks = time.ticks_ms()
+        s = None
+        try:
+            if self.__probe_addr is None:
+                self.__probe_addr = socket.getaddrinfo(self.probe_host, self.probe_port)[0][-1]
+            s = socket.socket()
+            s.settimeout(self.probe_timeout)
+            s.connect(self.__probe_addr)
+            self.report(True)
+        except Exception:
+            self.report(False)
+        finally:
+            if s is not None:
+                s.close()
+
+    def is_online(self):
+        verdict = self.get_verdict()
+        if verdict is not None:
+            return verdict
+
+        if (
+            self.__probe_ticks is not None
+            and time.ticks_diff(time.ticks_ms(), self.__probe_ticks) < self.min_probe_interval_ms
+        ):
+            # Rate-limited: keep the last known verdict even if it expired
+            return bool(self.__online)
+
+        self.__probe()
+        return self.__online
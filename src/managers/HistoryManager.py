@@ -0,0 +1,265 @@
+import os, json, struct, time
+
+class HistoryManager:
+    """
+    Append-only price history on the SD card. Every record has a fixed size and
+    records are written one full 512 byte sector at a time. Once the file holds
+    capacity_sectors sectors it wraps around and overwrites the oldest sector.
+    Records store a one byte slot per station; the station id of every slot is
+    kept in a table next to the file, so the history follows the station and not
+    its position in the polled list.
+    """
+    # Station slot, timestamp (s), price in tenths of a cent, status code
+    RECORD_FORMAT = "<BIHB"
+    RECORD_SIZE = 8
+    SECTOR_SIZE = 512
+    RECORDS_PER_SECTOR = SECTOR_SIZE // RECORD_SIZE
+    # Pads a partially filled sector when it has to be written early
+    EMPTY_STATION = 0xFF
+    MAX_SLOTS = 0xFF
+    NO_PRICE = 0xFFFF
+    STATUS_CODES = {None: 0, "open": 1, "closed": 2, "no prices": 3}
+    STATUS_NAMES = {0: None, 1: "open", 2: "closed", 3: "no prices"}
+    INDEX_SCAN_LIMIT = 16
+
+    def __init__(self, path="/sd/history.bin", capacity_sectors=256, index_size=96, flush_interval=3600):
+        self.path = path
+        self.capacity_sectors = capacity_sectors
+        self.index_size = index_size
+        self.flush_interval = flush_interval
+        self.__buffer = bytearray(self.SECTOR_SIZE)
+        self.__sector = bytearray(self.SECTOR_SIZE)
+        self.__buffered = 0
+        self.__buffer_started = None
+        self.__last_timestamp = 0
+        self.__index = {}
+        self.slots_path = path + ".ids"
+        self.__load_slots()
+        self.__sectors, self.__head = self.__locate_head()
+        if self.__sectors:
+            self.__load_index()
+
+    def __load_slots(self):
+        try:
+            with open(self.slots_path, "r") as f:
+                table = json.load(f)
+            self.__slots = table["slots"]
+            self.__next_recycled = table["next"]
+        except Exception:
+            # Without the table the records cannot be attributed to stations
+            self.__slots = []
+            self.__next_recycled = 0
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        self.__slot_of = {station_id: slot for slot, station_id in enumerate(self.__slots)}
+
+    def __save_slots(self):
+        try:
+            with open(self.slots_path + ".tmp", "w") as f:
+                json.dump({"slots": self.__slots, "next": self.__next_recycled}, f)
+            try:
+                os.remove(self.slots_path)
+            except OSError:
+                pass
+            os.rename(self.slots_path + ".tmp", self.slots_path)
+        except OSError as e:
+            print(e)
+
+    def __get_slot(self, station_id):
+        slot = self.__slot_of.get(station_id)
+        if slot is not None:
+            return slot
+
+        if len(self.__slots) < self.MAX_SLOTS:
+            slot = len(self.__slots)
+            self.__slots.append(station_id)
+        else:
+            # All slots taken: the oldest assigned slot is handed over, its old
+            # records on the card count for the new station until overwritten
+            slot = self.__next_recycled
+            self.__next_recycled = (slot + 1) % self.MAX_SLOTS
+            del self.__slot_of[self.__slots[slot]]
+            self.__slots[slot] = station_id
+            self.__index.pop(slot, None)
+        self.__slot_of[station_id] = slot
+        self.__save_slots()
+        return slot
+
+    def __open(self):
+        try:
+            return open(self.path, "r+b")
+        except OSError:
+            return open(self.path, "w+b")
+
+    def __read_sector(self, f, physical):
+        f.seek(physical * self.SECTOR_SIZE)
+        return f.readinto(self.__sector) == self.SECTOR_SIZE
+
+    def __first_timestamp(self, f, physical):
+        self.__read_sector(f, physical)
+        return struct.unpack_from(self.RECORD_FORMAT, self.__sector, 0)[1]
+
+    def __locate_head(self):
+        try:
+            sectors = os.stat(self.path)[6] // self.SECTOR_SIZE
+        except OSError:
+            return 0, 0
+
+        if sectors < self.capacity_sectors:
+            return sectors, sectors
+
+        # A full ring is sorted by time but rotated, so the oldest sector, which is
+        # also the next one to overwrite, is found with a binary search
+        with open(self.path, "rb") as f:
+            low, high = 0, self.capacity_sectors - 1
+            while low < high:
+                middle = (low + high) // 2
+                if self.__first_timestamp(f, middle) > self.__first_timestamp(f, high):
+                    low = middle + 1
+                else:
+                    high = middle
+        return self.capacity_sectors, low
+
+    def __physical(self, logical):
+        if self.__sectors < self.capacity_sectors:
+            return logical
+        return (self.__head + logical) % self.capacity_sectors
+
+    def __remember(self, station, timestamp, price, status):
+        entries = self.__index.get(station)
+        if entries is None:
+            entries = self.__index[station] = []
+        entries.append((timestamp, price, status))
+        if len(entries) > self.index_size:
+            entries.pop(0)
+
+    def __records(self, buffer, count):
+        for i in range(count):
+            station, timestamp, price, status = struct.unpack_from(self.RECORD_FORMAT, buffer, i * self.RECORD_SIZE)
+            if station != self.EMPTY_STATION:
+                yield station, timestamp, price, status
+
+    def __load_index(self):
+        # Walk back from the newest sector until every station seen has a full index
+        loaded = []
+        counts = {}
+        with open(self.path, "rb") as f:
+            for logical in range(self.__sectors - 1, max(-1, self.__sectors - 1 - self.INDEX_SCAN_LIMIT), -1):
+                if not self.__read_sector(f, self.__physical(logical)):
+                    continue
+                records = list(self.__records(self.__sector, self.RECORDS_PER_SECTOR))
+                loaded.append(records)
+                for record in records:
+                    counts[record[0]] = counts.get(record[0], 0) + 1
+                if counts and min(counts.values()) >= self.index_size:
+                    break
+
+        for records in reversed(loaded):
+            for station, timestamp, price, status in records:
+                self.__remember(station, timestamp, price, status)
+                self.__last_timestamp = timestamp
+
+    def encode_price(self, price):
+        return self.NO_PRICE if price is None else int(price * 1000 + .5)
+
+    def decode_price(self, value):
+        return None if value == self.NO_PRICE else value / 1000
+
+    def append(self, station_id, price, status, timestamp=None):
+        timestamp = int(time.time() if timestamp is None else timestamp)
+        # The ring must stay sorted by time for the binary searches, so a record
+        # from a clock that is not set yet or went backwards is dropped
+        if timestamp < self.__last_timestamp:
+            return
+        station = self.__get_slot(station_id)
+        price = self.encode_price(price)
+        status = self.STATUS_CODES.get(status, 0)
+        struct.pack_into(self.RECORD_FORMAT, self.__buffer, self.__buffered * self.RECORD_SIZE,
+                         station, timestamp, price, status)
+        self.__buffered += 1
+        self.__last_timestamp = timestamp
+        self.__remember(station, timestamp, price, status)
+        if self.__buffer_started is None:
+            self.__buffer_started = timestamp
+
+        if (
+            self.__buffered == self.RECORDS_PER_SECTOR
+            or not 0 <= timestamp - self.__buffer_started < self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        if not self.__buffered:
+            return
+
+        for i in range(self.__buffered, self.RECORDS_PER_SECTOR):
+            struct.pack_into(self.RECORD_FORMAT, self.__buffer, i * self.RECORD_SIZE,
+                             self.EMPTY_STATION, self.__last_timestamp, self.NO_PRICE, 0)
+
+        if self.__sectors < self.capacity_sectors:
+            physical = self.__sectors
+        else:
+            physical = self.__head
+        try:
+            with self.__open() as f:
+                f.seek(physical * self.SECTOR_SIZE)
+                f.write(self.__buffer)
+        except OSError as e:
+            print(e)
+            return
+
+        if self.__sectors < self.capacity_sectors:
+            self.__sectors += 1
+            self.__head = self.__sectors % self.capacity_sectors
+        else:
+            self.__head = (self.__head + 1) % self.capacity_sectors
+        self.__buffered = 0
+        self.__buffer_started = None
+
+    def get_latest(self, station_id):
+        """Returns up to index_size (timestamp, price, status) entries from RAM, oldest first."""
+        return [
+            (timestamp, self.decode_price(price), self.STATUS_NAMES.get(status))
+            for timestamp, price, status in self.__index.get(self.__slot_of.get(station_id), ())
+        ]
+
+    def __find_first_sector(self, f, start):
+        # Last sector whose first record is not newer than start
+        low, high = 0, self.__sectors - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.__first_timestamp(f, self.__physical(middle)) <= start:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def query(self, station_id, start, end):
+        """Returns all (timestamp, price, status) records of a station with start <= timestamp <= end."""
+        result = []
+        station = self.__slot_of.get(station_id)
+        if station is None:
+            return result
+        if self.__sectors:
+            with open(self.path, "rb") as f:
+                for logical in range(self.__find_first_sector(f, start), self.__sectors):
+                    if not self.__read_sector(f, self.__physical(logical)):
+                        break
+                    if struct.unpack_from(self.RECORD_FORMAT, self.__sector, 0)[1] > end:
+                        break
+                    for record in self.__records(self.__sector, self.RECORDS_PER_SECTOR):
+                        if record[0] == station and start <= record[1] <= end:
+                            result.append((record[1], self.decode_price(record[2]), self.STATUS_NAMES.get(record[3])))
+
+        for record in self.__records(self.__buffer, self.__buffered):
+            if record[0] == station and start <= record[1] <= end:
+                result.append((record[1], self.decode_price(record[2]), self.STATUS_NAMES.get(record[3])))
+        return result
+
+    def get_min_max(self, station_id, start, end):
+        prices = [price for _, price, _ in self.query(station_id, start, end) if price is not None]
+        if not prices:
+            return None, None
+        return min(prices), max(prices)
@@ -0,0 +1,299 @@
+import time
+import uasyncio as asyncio
+
+class RefreshManager:
+    SNAPSHOT_KEY = "snapshot"
+    # A reconnect restarts the association, so a new one waits until the last one had time to finish
+    RECONNECT_INTERVAL_MS = 60000
+
+    def __init__(self, display_manager, sd_card_manager, time_manager, weather_manager, station_manager,
+                 discovery_manager=None, station_count=3, boot=None, cache=None, wlan=None):
+        self.display_manager = display_manager
+        self.sd_card_manager = sd_card_manager
+        self.time_manager = time_manager
+        self.weather_manager = weather_manager
+        self.station_manager = station_manager
+        # With a DiscoveryManager the cheapest station_count of the discovered stations are shown
+        self.discovery_manager = discovery_manager
+        self.station_count = station_count
+        # Optional BootManager that records when the first data of each source was drawn
+        self.boot = boot
+        # Optional CacheManager that keeps the last drawn data to show it right after a reset
+        self.cache = cache
+        # Optional WlanManager: while its verdict is offline the requests are skipped and it reconnects
+        self.wlan = wlan
+        self.__snapshot = {}
+        self.__snapshot_changed = []
+        self.__stale = False
+        self.__ranking = None
+        self.__stations = []
+        self.__brand_icons = {}
+        self.__trends_loaded = False
+        self.__time_ready = None
+        self.__reconnected = None
+
+    def __mark(self, event):
+        if self.boot is not None:
+            self.boot.mark(event)
+
+    def __has_prices(self, fuel_prices):
+        # Fallback data after a failed fetch holds no price
+        return any(price != "-,--" for price in fuel_prices)
+
+    def __update_snapshot(self, key, entry):
+        self.__snapshot[key] = entry
+        if key not in self.__snapshot_changed:
+            self.__snapshot_changed.append(key)
+
+    def __save_snapshot(self):
+        # Entries are stamped at the end of the cycle, after the first NTP sync finished
+        if self.cache is None or not self.__snapshot_changed or not self.time_manager.synced:
+            return
+        now = self.time_manager.get_time()
+        for key in self.__snapshot_changed:
+            self.__snapshot[key]["time"] = now
+        self.__snapshot_changed = []
+        self.cache.save(self.SNAPSHOT_KEY, self.__snapshot)
+
+    def __restore_stations(self, stations):
+        if self.discovery_manager is not None:
+            if "icons" not in stations:
+                return False
+            self.display_manager.set_stations(
+                [self.__get_brand_icon(brand) for brand in stations["icons"]], stations["labels"]
+            )
+        elif stations["ids"] != self.station_manager.station_ids:
+            return False
+        self.display_manager.draw_station_data(stations["statuses"], stations["prices"], stale=True)
+        self.__stale = True
+        return True
+
+    def restore_snapshot(self):
+        """
+        Draws the data saved by the last run with its age, so the screen is useful
+        right after a reset. Restored prices stay grey until fresh prices arrive.
+        Returns True if anything was drawn.
+        """
+        if self.cache is None:
+            return False
+        snapshot = self.cache.load(self.SNAPSHOT_KEY)
+        if not snapshot:
+            return False
+
+        times = []
+        try:
+            weather = snapshot.get("weather")
+            if weather:
+                self.display_manager.draw_weather_data(
+                    weather["data"], weather["icon"], self.sd_card_manager.get_icon("weather", weather["icon"])
+                )
+                times.append(weather["time"])
+            stations = snapshot.get("stations")
+            if stations and self.__restore_stations(stations):
+                times.append(stations["time"])
+        except Exception as e:
+            print(e)
+        if not times:
+            return False
+
+        self.__snapshot = snapshot
+        age = None
+        # The RTC survives machine.reset(), after a power loss the age is unknown
+        if self.time_manager.synced:
+            age = max(0, self.time_manager.get_time() - min(times))
+        self.display_manager.draw_data_age(age)
+        return True
+
+    async def __refresh_time(self, sync):
+        try:
+            # The drift estimate decides whether NTP is actually needed yet
+            if sync and self.time_manager.sync_due():
+                error_code, error_text = await self.time_manager.sync_time_async()
+                if error_code != "OK":
+                    return error_code, error_text
+        finally:
+            self.__time_ready.set()
+
+        self.display_manager.draw_weekday_date_time(self.time_manager.get_timedate())
+        self.__mark("first_time")
+        return "OK", None
+
+    async def __refresh_weather(self):
+        # The forecast is requested per date, so the first fetch after boot waits for NTP
+        if not self.time_manager.synced:
+            await self.__time_ready.wait()
+        # Without a successful sync the RTC date is wrong; the failed time refresh makes
+        # the cycle fail, so the weather is retried together with the next sync
+        if not self.time_manager.synced:
+            return "OK", None
+
+        weather_data, weather_icon_name = await self.weather_manager.get_weather_data_async(
+            self.time_manager.get_timestamp()
+        )
+        weather_icon = None
+        if weather_icon_name != self.display_manager.currently_displayed.get("weather_icon_name"):
+            weather_icon = self.sd_card_manager.get_icon("weather", weather_icon_name)
+        self.display_manager.draw_weather_data(weather_data, weather_icon_name, weather_icon)
+        self.__update_snapshot("weather", {"data": weather_data, "icon": weather_icon_name})
+        self.__mark("first_weather")
+        return "OK", None
+
+    def __get_brand_icon(self, brand):
+        brand = brand.lower()
+        if brand not in self.__brand_icons:
+            self.__brand_icons[brand] = self.sd_card_manager.get_icon("station", brand)
+        return self.__brand_icons[brand]
+
+    def __draw_price_trends(self, station_indices):
+        # Sparklines need the real time; before the first NTP sync they are left alone
+        if not self.time_manager.synced:
+            return
+
+        history = self.station_manager.history
+        station_ids = self.station_manager.station_ids
+        raw_prices = self.station_manager.get_raw_prices()
+        now = time.time()
+        for position, i in enumerate(station_indices):
+            if not self.__trends_loaded and history is not None:
+                self.display_manager.load_price_trend(position, history.get_latest(station_ids[i]))
+            self.display_manager.draw_price_trend(position, now, raw_prices[i])
+        self.__trends_loaded = True
+
+    async def __refresh_discovered_stations(self):
+        stations = await self.discovery_manager.get_stations_async()
+        if stations is not self.__stations:
+            self.__stations = stations
+            self.__ranking = None
+            self.station_manager.set_station_ids([station["id"] for station in stations])
+
+        station_data = await self.station_manager.get_station_changes_async()
+        if station_data is None:
+            return "OK", None
+
+        station_statuses, fuel_prices, changed = station_data
+        has_prices = self.__has_prices(fuel_prices)
+        if self.__stale and not has_prices:
+            # A failed first fetch leaves the restored stations on the screen
+            return "OK", None
+
+        ranking = self.station_manager.get_cheapest_stations(self.station_count)
+        if ranking == self.__ranking and not self.__stale and not any(stations[i]["id"] in changed for i in ranking):
+            self.__draw_price_trends(ranking)
+            return "OK", None
+
+        brands = [stations[i]["brand"] for i in ranking]
+        labels = [["", stations[i]["brand"] or stations[i]["name"], stations[i]["place"]] for i in ranking]
+        if ranking != self.__ranking:
+            self.__ranking = ranking
+            self.__trends_loaded = False
+            self.display_manager.set_stations([self.__get_brand_icon(brand) for brand in brands], labels)
+
+        statuses = [station_statuses[i] for i in ranking]
+        prices = [fuel_prices[i] for i in ranking]
+        # The DisplayManager only writes the rows whose status or price differs from the screen
+        self.display_manager.draw_station_data(statuses, prices)
+        self.__stale = False
+        if has_prices:
+            self.__mark("first_price")
+            self.__update_snapshot("stations", {
+                "ids": [stations[i]["id"] for i in ranking],
+                "icons": brands,
+                "labels": labels,
+                "statuses": statuses,
+                "prices": prices
+            })
+        self.__draw_price_trends(ranking)
+        return "OK", None
+
+    async def __refresh_stations(self):
+        if self.discovery_manager is not None:
+            return await self.__refresh_discovered_stations()
+
+        # None means the polling policy skipped this cycle or the API throttled us
+        station_data = await self.station_manager.get_station_changes_async()
+        if station_data is not None:
+            station_statuses, fuel_prices, changed = station_data
+            has_prices = self.__has_prices(fuel_prices)
+            if self.__stale and not has_prices:
+                # A failed first fetch leaves the restored prices on the screen
+                return "OK", None
+
+            if not changed and not self.__stale:
+                self.__draw_price_trends(range(len(station_statuses)))
+                return "OK", None
+
+            self.display_manager.draw_station_data(station_statuses, fuel_prices)
+            self.__stale = False
+            if has_prices:
+                self.__mark("first_price")
+                self.__update_snapshot("stations", {
+                    "ids": self.station_manager.station_ids,
+                    "statuses": station_statuses,
+                    "prices": fuel_prices
+                })
+            self.__draw_price_trends(range(len(station_statuses)))
+        return "OK", None
+
+    def __reconnect(self):
+        now = time.ticks_ms()
+        if self.__reconnected is not None and time.ticks_diff(now, self.__reconnected) < self.RECONNECT_INTERVAL_MS:
+            return
+        self.__reconnected = now
+        try:
+            self.wlan.reconnect()
+        except Exception as e:
+            print(e)
+
+    async def refresh(self, sync_time=True, weather=True, stations=True):
+        """
+        Fetches all requested sources concurrently. Each source is drawn as soon as
+        its own data arrives, so a cycle takes as long as the slowest source.
+        Returns the first error code and text, or ("OK", None).
+        """
+        offline = None
+        if self.wlan is not None:
+            offline = self.wlan.device_online()
+            if offline[0] == "OK":
+                offline = None
+            else:
+                # Every request would only run into its timeout; the clock is still drawn
+                sync_time, weather, stations = False, False, False
+                self.__reconnect()
+
+        self.__time_ready = asyncio.Event()
+        tasks = [self.__refresh_time(sync_time)]
+        if weather:
+            tasks.append(self.__refresh_weather())
+        if stations:
+            tasks.append(self.__refresh_stations())
+
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        self.__save_snapshot()
+        for result in results:
+            if isinstance(result, Exception):
+                print(result)
+            elif result[0] != "OK":
+                return result
+
+        return offline or ("OK", None)
+
+    def __draw_clock(self, timedate, changed):
+        self.display_manager.draw_weekday_date_time(timedate)
+
+    async def run_clock(self):
+        await self.time_manager.run_clock(self.__draw_clock)
+
+    async def run_pages(self, interval=10):
+        """Shows the next station page every interval seconds if the stations do not fit on one page."""
+        while True:
+            await asyncio.sleep(interval)
+            self.display_manager.show_next_station_page()
+
+    def shutdown(self):
+        """Writes the buffered price history to the SD card, call it before a reset."""
+        history = self.station_manager.history
+        if history is not None:
+            history.flush()
+
+    def run_refresh(self, sync_time=True, weather=True, stations=True):
+        return asyncio.run(self.refresh(sync_time, weather, stations))
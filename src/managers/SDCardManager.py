@@ -4,12 +4,15 @@ from drivers.sdcard import SDCard
 from hashdata import EXPECTED_HASHES
 
 class SDCardManager:
+    MAX_STATIONS = 20
+
     def __init__(self):
         self.properties = {}
         self.uuid_regex = ure.compile(r"^[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}$")
         self.sd = None
         
-    def open_sd_card(self):
+    def open_sd_card(self, validate=True):
+        # Startup passes validate=False and calls validate_hashes() while the WLAN associates
         try:
             os.listdir("/sd")
             return "OK", None
@@ -17,16 +20,21 @@ class SDCardManager:
             try:
                 self.sd = SDCard(SPI(1, baudrate=2000000, sck=Pin(21), mosi=Pin(39), miso=Pin(40)), Pin(38))
                 os.mount(self.sd, "/sd")
-                if not self.__validate_hashes():
-                    return "1102", ["There are missing or corrupted contents",
-                                    "on the SD card! Please double-check the",
-                                    "SD card for missing folders and files!"]
+                if validate:
+                    return self.validate_hashes()
                 return "OK", None
 
             except Exception:
                 return "1101", ["SD Card is missing or has wrong",
                                 "format, it should be FAT32 formatted!"]
 
+    def validate_hashes(self):
+        if not self.__validate_hashes():
+            return "1102", ["There are missing or corrupted contents",
+                            "on the SD card! Please double-check the",
+                            "SD card for missing folders and files!"]
+        return "OK", None
+
     def validate_contents(self):
         if "properties.json" not in os.listdir("/sd"):
             return "1103", ["Missing properties.json file!"]
@@ -152,28 +160,39 @@ class SDCardManager:
                             "Please provide a valid API key in the",
                             "properties.json file!"]
 
+    def __discovery_enabled(self):
+        return self.properties.get("station_ids") is None and self.properties.get("station_radius") is not None
+
     def __check_station_ids(self):
         station_ids = self.properties.get("station_ids")
-        if (
+        if self.__discovery_enabled():
+            return "OK", None
+        elif (
             isinstance(station_ids, list)
-            and len(station_ids) == 3
+            and 1 <= len(station_ids) <= self.MAX_STATIONS
             and all(isinstance(i, str) and self.__is_valid_uuid(i) and i.strip() for i in station_ids)
         ):
             if any(station_ids.count(x) > 1 for x in station_ids):
                 return "1205", ["The station ID's are not unique!",
-                            "Please provide three unique station ID's",
-                            "in the properties.json file!"]
+                            "Please provide unique station ID's in",
+                            "the properties.json file!"]
             else:
                 return "OK", None
         else:
             return "1204", ["The station ID's are not valid!",
-                            "Please provide three valid station ID's",
+                            f"Please provide 1 to {self.MAX_STATIONS} valid station ID's",
                             "as a list in the properties.json file!"]
         
     def __check_station_labels(self):
         valid_labels = True
+        if self.__discovery_enabled():
+            return "OK", None
+
         station_labels = self.properties.get("station_labels")
-        if not isinstance(station_labels, list) or len(station_labels) != 3:
+        station_ids = self.properties.get("station_ids")
+        station_count = len(station_ids) if isinstance(station_ids, list) else 0
+        if not isinstance(station_labels, list) or len(station_labels) != station_count:
+            station_labels = []
             valid_labels = False
 
         for row in station_labels:
@@ -182,7 +201,7 @@ class SDCardManager:
                 break
 
             for item in row:
-                if item is not isinstance(item, str):
+                if not isinstance(item, str):
                     valid_labels = False
                     break
             
@@ -193,8 +212,25 @@ class SDCardManager:
             return "OK", None
         else:
             return "1206", ["The station labels are not valid!",
-                            "Please provide valid station labels as a",
-                            "3x3 list in the properties.json file!"]
+                            "Please provide three labels for every",
+                            "station in the properties.json file!"]
+
+    def __check_station_discovery(self):
+        if not self.__discovery_enabled():
+            return "OK", None
+
+        station_radius = self.properties.get("station_radius")
+        station_count = self.properties.get("station_count", 3)
+        if (
+            isinstance(station_radius, (int, float)) and 0 < station_radius <= 25
+            and isinstance(station_count, int) and 1 <= station_count <= self.MAX_STATIONS
+        ):
+            return "OK", None
+        else:
+            return "1212", ["The station search is not valid!",
+                            "Please provide a station_radius up to",
+                            f"25 km and a station_count up to {self.MAX_STATIONS}",
+                            "in the properties.json file!"]
 
     def __check_fuel_type(self):
         fuel_type = self.properties.get("fuel_type")
@@ -226,6 +262,48 @@ class SDCardManager:
                             "the properties.json file!",
                             "Valid longitudes are between -180 and 180"]
 
+    def __check_forecast_ttl(self):
+        for name in ("forecast_ttl", "forecast_max_age"):
+            value = self.properties.get(name)
+            if value is not None and (not isinstance(value, (int, float)) or value <= 0):
+                return "1210", ["The forecast cache times are not valid!",
+                                "Please provide forecast_ttl and",
+                                "forecast_max_age as positive numbers of",
+                                "seconds in the properties.json file!"]
+
+        return "OK", None
+
+    def __check_timezone(self):
+        timezone_rule = self.properties.get("timezone_rule", "eu")
+        timezone_offset = self.properties.get("timezone_offset", 1)
+        if (
+            timezone_rule in ("eu", "us", "fixed")
+            and isinstance(timezone_offset, (int, float)) and -12 <= timezone_offset <= 14
+        ):
+            return "OK", None
+        else:
+            return "1213", ["The timezone is not valid!",
+                            "Please provide eu, us or fixed as the",
+                            "timezone_rule and a timezone_offset in",
+                            "hours in the properties.json file!"]
+
+    def __check_refresh_intervals(self):
+        refresh_intervals = self.properties.get("refresh_intervals")
+        if refresh_intervals is None:
+            return "OK", None
+
+        if isinstance(refresh_intervals, dict) and all(
+            key in ("clock", "prices", "forecast", "ntp")
+            and isinstance(value, (int, float)) and value > 0
+            for key, value in refresh_intervals.items()
+        ):
+            return "OK", None
+        else:
+            return "1211", ["The refresh intervals are not valid!",
+                            "Please provide positive numbers of seconds",
+                            "for clock, prices, forecast and ntp in",
+                            "the properties.json file!"]
+
     def get_property_value(self, property_name):
         property = self.properties.get(property_name)
         if property is None:
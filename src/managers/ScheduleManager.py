@@ -0,0 +1,152 @@
+import time, heapq, random
+import uasyncio as asyncio
+
+class ScheduledTask:
+    def __init__(self, name, callback, interval, align, jitter):
+        self.name = name
+        self.callback = callback
+        self.interval = interval
+        self.align = align
+        self.jitter = jitter
+        self.failures = 0
+        self.deadline = 0
+
+    def get_interval(self):
+        # A callable interval is asked again for every deadline, e.g. the adaptive NTP spacing
+        return self.interval() if callable(self.interval) else self.interval
+
+class ScheduleManager:
+    DEFAULT_INTERVALS = {
+        "clock": 60,
+        "prices": 300,
+        "forecast": 3600,
+        "ntp": 86400
+    }
+
+    def __init__(self, intervals=None, jitter=0.1, backoff_base=15, backoff_max=3600):
+        self.intervals = dict(self.DEFAULT_INTERVALS)
+        if intervals:
+            self.intervals.update(intervals)
+        self.jitter = jitter
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.__queue = []
+        self.__sequence = 0
+        self.__tasks = {}
+
+    def __push(self, task):
+        # The sequence number keeps equal deadlines in insertion order and never compares tasks
+        self.__sequence += 1
+        heapq.heappush(self.__queue, (task.deadline, self.__sequence, task))
+
+    def __next_deadline(self, task, now):
+        interval = task.get_interval()
+        if task.align:
+            # Wall-clock aligned tasks fire exactly on the next interval boundary
+            return (now // interval + 1) * interval
+
+        # +-jitter spreads a fleet that was powered on at the same moment over time
+        spread = interval * task.jitter
+        return now + interval + (random.random() * 2 - 1) * spread
+
+    def __backoff_deadline(self, task, now):
+        delay = min(self.backoff_base * (1 << min(task.failures - 1, 16)), self.backoff_max, task.get_interval())
+        # Equal jitter: wait at least half of the backoff so retries stay bounded
+        return now + delay / 2 + random.random() * delay / 2
+
+    def add(self, name, callback, align=False, jitter=None, run_now=True, interval=None):
+        """
+        Registers a callback under a source name. The interval comes from the
+        intervals passed to the constructor (properties.json "refresh_intervals")
+        unless one is given, which may also be a function returning the seconds
+        to the next run. The callback may be a plain function or a coroutine
+        function and counts as failed if it raises, returns False or returns a
+        non-"OK" error code.
+        """
+        task = ScheduledTask(name, callback, self.intervals[name] if interval is None else interval, align,
+                             self.jitter if jitter is None else jitter)
+        now = time.time()
+        task.deadline = now if run_now else self.__next_deadline(task, now)
+        self.__tasks[name] = task
+        self.__push(task)
+
+    def trigger(self, name):
+        """Makes a registered task due immediately, e.g. after reconnecting to the WLAN."""
+        task = self.__tasks.get(name)
+        if task is not None:
+            task.deadline = time.time()
+            self.__push(task)
+
+    def time_until_next(self):
+        self.__drop_superseded()
+        if not self.__queue:
+            return None
+        return max(0, self.__queue[0][0] - time.time())
+
+    def __drop_superseded(self):
+        # trigger() leaves the previous heap entry behind; only the entry matching
+        # the task's current deadline is live
+        while self.__queue and self.__queue[0][2].deadline != self.__queue[0][0]:
+            heapq.heappop(self.__queue)
+
+    def __clamp_deadlines(self, now):
+        # A clock that jumped backwards would otherwise park every task far in the future
+        for task in self.__tasks.values():
+            if task.deadline - now > task.get_interval() * (1 + task.jitter) + self.backoff_max:
+                task.deadline = now
+                self.__push(task)
+
+    def __succeeded(self, result):
+        if result is None or result is True:
+            return True
+        if isinstance(result, tuple):
+            return result[0] == "OK"
+        return bool(result)
+
+    async def __run_task(self, task):
+        try:
+            result = task.callback()
+            if hasattr(result, "send"):
+                result = await result
+            succeeded = self.__succeeded(result)
+        except Exception as e:
+            print(e)
+            succeeded = False
+
+        now = time.time()
+        if succeeded:
+            task.failures = 0
+            task.deadline = self.__next_deadline(task, now)
+        else:
+            task.failures += 1
+            task.deadline = self.__backoff_deadline(task, now)
+        self.__push(task)
+
+    async def run_due(self):
+        """
+        Runs every task whose deadline has passed. A task that is overdue by
+        several intervals (e.g. after the clock jumped on the first NTP sync)
+        runs once and is rescheduled from now instead of catching up.
+        """
+        now = time.time()
+        due = []
+        self.__clamp_deadlines(now)
+        self.__drop_superseded()
+        while self.__queue and self.__queue[0][0] <= now:
+            task = heapq.heappop(self.__queue)[2]
+            if task not in due:
+                due.append(task)
+            self.__drop_superseded()
+
+        for task in due:
+            await self.__run_task(task)
+
+        return len(due)
+
+    async def run(self):
+        while True:
+            await self.run_due()
+            delay = self.time_until_next()
+            if delay is None:
+                return
+            await asyncio.sleep_ms(int(delay * 1000))
@@ -0,0 +1,146 @@
+import time
+import uasyncio as asyncio
+from drivers.xglcd_font import XglcdFont
+from managers.BootManager import BootManager
+from managers.CacheManager import CacheManager
+from managers.DiscoveryManager import DiscoveryManager
+from managers.DisplayManager import DisplayManager
+from managers.HistoryManager import HistoryManager
+from managers.RefreshManager import RefreshManager
+from managers.SDCardManager import SDCardManager
+from managers.StationManager import StationManager
+from managers.TimeManager import TimeManager
+from managers.TimezoneManager import TimezoneManager
+from managers.WeatherManager import WeatherManager
+from managers.WlanManager import WlanManager
+
+class StartupManager:
+    """
+    Brings the device from reset to the first prices. Only the SD card and the
+    properties are needed before the WLAN connect starts. The association then runs
+    in the radio while the fonts load, the display initializes, the SD card contents
+    are validated and the layout and the data of the last run are drawn. The first
+    refresh then fetches the time, the weather and the prices concurrently. Every
+    stage is recorded by the BootManager.
+    """
+    # Symbols in front of the current temperature, rain probability, minimum and maximum
+    WEATHER_SYMBOLS = ("thermometer", "raindrop", "lowest-temperature", "highest-temperature")
+
+    def __init__(self, boot=None, wlan_timeout_ms=30000):
+        self.boot = boot if boot is not None else BootManager()
+        self.wlan_timeout_ms = wlan_timeout_ms
+        self.sd_card_manager = SDCardManager()
+        self.display_manager = None
+        self.wlan_manager = None
+        self.time_manager = None
+        self.refresh_manager = None
+
+    def __open_sd_card(self):
+        error_code, error_text = self.boot.run("sd_mount", self.sd_card_manager.open_sd_card, False)
+        if error_code != "OK":
+            return error_code, error_text
+        return self.boot.run("properties", self.sd_card_manager.validate_contents)
+
+    def __start_wlan(self):
+        self.wlan_manager = WlanManager()
+        # connect() only starts the association, it completes in the background
+        self.wlan_manager.connect(
+            self.sd_card_manager.properties.get("wlan_ssid"),
+            self.sd_card_manager.properties.get("wlan_psk")
+        )
+
+    def __load_display(self):
+        ili_font = self.boot.run("font_ili", XglcdFont, "fonts/ILIFont10x19.c", 10, 19)
+        price_font = self.boot.run("font_price", XglcdFont, "fonts/PriceFont15x33.c", 15, 33)
+        self.display_manager = self.boot.run("display_init", DisplayManager, ili_font, price_font)
+
+    def __create_managers(self):
+        properties = self.sd_card_manager.properties
+        health = self.wlan_manager.health
+        cache = CacheManager()
+        lat = properties.get("weather_lat")
+        long = properties.get("weather_long")
+        api_key = properties.get("tankerkoenig_api_key")
+        station_ids = properties.get("station_ids")
+
+        timezone = TimezoneManager(properties.get("timezone_rule", "eu"), properties.get("timezone_offset", 1))
+        self.time_manager = TimeManager(timezone)
+        weather_manager = WeatherManager(
+            lat, long, cache=cache, forecast_ttl=properties.get("forecast_ttl", 3600),
+            forecast_max_age=properties.get("forecast_max_age", 21600), health=health
+        )
+        discovery_manager = None
+        station_count = len(station_ids or [])
+        if station_ids is None:
+            station_count = properties.get("station_count", 3)
+            discovery_manager = DiscoveryManager(
+                lat, long, properties.get("station_radius"), api_key, cache=cache, health=health
+            )
+        station_manager = StationManager(
+            station_ids or [], properties.get("fuel_type"), api_key, history=HistoryManager(), health=health,
+            timezone=timezone, time_manager=self.time_manager
+        )
+        self.refresh_manager = RefreshManager(
+            self.display_manager, self.sd_card_manager, self.time_manager, weather_manager, station_manager,
+            discovery_manager, station_count, boot=self.boot, cache=cache, wlan=self.wlan_manager
+        )
+
+    def __draw_layout(self):
+        sd = self.sd_card_manager
+        station_labels = sd.properties.get("station_labels")
+        if station_labels is None:
+            # Discovered stations are drawn by the first refresh
+            station_labels = [["", "", ""]] * self.refresh_manager.station_count
+        self.display_manager.draw_main_layout(
+            [sd.get_icon("station", labels[0]) for labels in station_labels],
+            [sd.get_icon("symbol", name) for name in self.WEATHER_SYMBOLS],
+            station_labels,
+            sd.properties.get("fuel_type")
+        )
+
+    async def __wait_for_wlan(self):
+        started = time.ticks_ms()
+        while not self.wlan_manager.is_connected_boolean():
+            if time.ticks_diff(time.ticks_ms(), started) > self.wlan_timeout_ms:
+                break
+            await asyncio.sleep_ms(50)
+        return self.wlan_manager.is_connected()
+
+    async def start(self):
+        """
+        Runs the startup and the first refresh. Returns the first error code and
+        text, or ("OK", None). The display is initialized in both cases, so the
+        caller can always draw the error.
+        """
+        self.boot.mark("startup")
+        error = self.__open_sd_card()
+        if error[0] == "OK":
+            self.boot.start("wlan")
+            self.boot.run("wlan_connect", self.__start_wlan)
+
+        self.__load_display()
+        if error[0] != "OK":
+            return error
+
+        error = self.boot.run("sd_hashes", self.sd_card_manager.validate_hashes)
+        if error[0] != "OK":
+            return error
+
+        self.boot.run("managers", self.__create_managers)
+        self.boot.run("layout", self.__draw_layout)
+        # The data of the last run is shown until the first refresh replaces it
+        if self.boot.run("snapshot", self.refresh_manager.restore_snapshot):
+            self.boot.mark("first_snapshot")
+
+        error = await self.__wait_for_wlan()
+        self.boot.stop("wlan")
+        if error[0] != "OK":
+            return error
+
+        error = await self.boot.run_async("first_refresh", self.refresh_manager.refresh())
+        self.boot.report()
+        self.boot.save()
+        return error
+
+    def run(self):
+        return asyncio.run(self.start())
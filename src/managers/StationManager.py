@@ -1,4 +1,10 @@
-import urequests as requests
+import time
+from managers.HealthManager import reported_get, reported_get_async
+
+class StationThrottled(Exception):
+    def __init__(self, retry_after):
+        super().__init__("Tankerkoenig request throttled")
+        self.retry_after = retry_after
 
 class StationManager:
     __STATION_STATUSES = {
@@ -8,10 +14,60 @@ class StationManager:
         None: "STATUS UNKNOWN"
     }
     
-    def __init__(self, station_ids, fuel_type, api_key):
-        self.station_ids = station_ids
+    # prices.php accepts at most 10 station IDs per request
+    __BATCH_SIZE = 10
+    __THROTTLE_BACKOFF_BASE = 60
+    __THROTTLE_BACKOFF_MAX = 3600
+
+    def __init__(self, station_ids, fuel_type, api_key, min_interval=300, max_interval=1800, daily_budget=288,
+                 history=None, health=None, timezone=None, time_manager=None):
         self.fuel_type = fuel_type
+        # Optional HistoryManager that receives every observed price or status change
+        self.history = history
+        # Optional HealthManager that learns the connectivity verdict from these requests
+        self.health = health
+        # Optional TimezoneManager, price changes follow the local hour of the day
+        self.timezone = timezone
+        # Optional TimeManager, the history is only written once the clock was synced
+        self.time_manager = time_manager
         self.base_url_station_info = f"https://creativecommons.tankerkoenig.de/json/prices.php?apikey={api_key}"
+        self.__set_station_ids(station_ids)
+
+        # Polling policy: the interval adapts between min_interval and max_interval to the
+        # number of price changes usually seen in the current hour of the day, and a token
+        # bucket keeps this device within its share (daily_budget) of the API key quota
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.daily_budget = daily_budget
+        self.__tokens = self.__get_token_capacity()
+        self.__tokens_updated = time.time()
+        self.__last_poll = None
+        self.__blocked_until = 0
+        self.__throttled = 0
+        self.__volatility_hour = None
+
+    def __set_station_ids(self, station_ids):
+        self.station_ids = station_ids
+        self.__station_urls = [
+            f"{self.base_url_station_info}&ids={','.join(station_ids[i:i + self.__BATCH_SIZE])}"
+            for i in range(0, len(station_ids), self.__BATCH_SIZE)
+        ]
+        self.__volatility = [[0.] * 24 for _ in station_ids]
+        self.__changes_this_hour = [0] * len(station_ids)
+        self.__raw_prices = [None] * len(station_ids)
+        self.__raw_statuses = [None] * len(station_ids)
+        # IDs of the stations whose status or price changed in the last poll; nothing
+        # is drawn yet, and after a fallback every row shows it, so all count as changed
+        self.__changed = set()
+        self.__all_changed = True
+        # (price, index) of every open station with a known price, kept sorted as prices arrive
+        self.__ranking = []
+
+    def set_station_ids(self, station_ids):
+        """Replaces the polled stations, e.g. after a new station discovery."""
+        if station_ids != self.station_ids:
+            self.__set_station_ids(station_ids)
+            self.__last_poll = None
     
     def __get_station_status(self, data, station_id):
         try:
@@ -23,22 +79,231 @@ class StationManager:
 
     def __get_station_fuel_price(self, data, station_id):
         try:
-            data = data["prices"][station_id][self.fuel_type]
-            return f"{data:.2f}".replace(".", ",") if data is not None else "-,--"
+            data = data["prices"][station_id].get(self.fuel_type)
+            return f"{data:.2f}".replace(".", ",") if data else "-,--"
 
         except Exception:
             return "-,--"
         
+    def __check_response(self, response):
+        if response.status_code in (429, 503):
+            try:
+                retry_after = int(response.headers.get("Retry-After") or response.headers.get("retry-after"))
+            except Exception:
+                retry_after = None
+            response.close()
+            raise StationThrottled(retry_after)
+
+    def __merge_station_batch(self, merged, response):
+        self.__check_response(response)
+        data = response.json()
+        response.close()
+        merged.update(data["prices"])
+
+    def __read_station_data(self, merged):
+        # A batch that failed leaves its stations out and they show as unknown
+        if not merged:
+            raise OSError("No station data received")
+        data = {"prices": merged}
+        self.__throttled = 0
+        self.__record_prices(data)
+        statuses = [self.__get_station_status(data, sid) for sid in self.station_ids]
+        prices = [self.__get_station_fuel_price(data, sid) for sid in self.station_ids]
+        return statuses, prices
+
+    def __get_fallback_station_data(self):
+        statuses = [self.__STATION_STATUSES.get(None)] * len(self.station_ids)
+        prices = ["-,--"] * len(self.station_ids)
+        return statuses, prices
+
+    def __record_throttle(self, retry_after):
+        self.__throttled += 1
+        backoff = self.__THROTTLE_BACKOFF_BASE * (1 << min(self.__throttled - 1, 6))
+        backoff = min(backoff, self.__THROTTLE_BACKOFF_MAX)
+        self.__blocked_until = time.time() + max(backoff, retry_after or 0)
+
+    def __get_local_hour(self):
+        t = time.time()
+        if self.timezone is not None:
+            t += self.timezone.get_offset(t)
+        return time.gmtime(t)[3]
+
+    def __record_prices(self, data):
+        hour = self.__get_local_hour()
+        if self.__volatility_hour is not None and hour != self.__volatility_hour:
+            for i in range(len(self.station_ids)):
+                bucket = self.__volatility[i]
+                bucket[self.__volatility_hour] = 0.7 * bucket[self.__volatility_hour] + 0.3 * self.__changes_this_hour[i]
+                self.__changes_this_hour[i] = 0
+        self.__volatility_hour = hour
+
+        history_ready = self.history is not None and (self.time_manager is None or self.time_manager.synced)
+        self.__changed = set()
+        for i, sid in enumerate(self.station_ids):
+            # Closed stations are sent without fuel keys and missing prices as false
+            station = data["prices"].get(sid) or {}
+            status = station.get("status")
+            price = station.get(self.fuel_type) or None
+            if price is not None and self.__raw_prices[i] is not None and price != self.__raw_prices[i]:
+                self.__changes_this_hour[i] += 1
+            if price != self.__raw_prices[i] or status != self.__raw_statuses[i]:
+                self.__changed.add(sid)
+            if history_ready and (
+                (price is not None and price != self.__raw_prices[i]) or status != self.__raw_statuses[i]
+            ):
+                self.history.append(sid, price, status)
+            old_price, old_status = self.__raw_prices[i], self.__raw_statuses[i]
+            self.__raw_statuses[i] = status
+            if price is not None:
+                self.__raw_prices[i] = price
+            if (old_price, old_status) != (self.__raw_prices[i], status):
+                self.__update_ranking(i, old_price, old_status)
+
+    def __find_rank(self, entry):
+        low, high = 0, len(self.__ranking)
+        while low < high:
+            middle = (low + high) // 2
+            if self.__ranking[middle] < entry:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __update_ranking(self, i, old_price, old_status):
+        if old_price is not None and old_status == "open":
+            del self.__ranking[self.__find_rank((old_price, i))]
+        price = self.__raw_prices[i]
+        if price is not None and self.__raw_statuses[i] == "open":
+            entry = (price, i)
+            self.__ranking.insert(self.__find_rank(entry), entry)
+
+    def __get_token_capacity(self):
+        return max(len(self.__station_urls), self.daily_budget / 24)
+
+    def __refill_tokens(self, now):
+        self.__tokens = min(self.__get_token_capacity(), self.__tokens + (now - self.__tokens_updated) * self.daily_budget / 86400)
+        self.__tokens_updated = now
+
+    def get_poll_interval(self):
+        hour = self.__get_local_hour()
+        changes_per_hour = max((bucket[hour] for bucket in self.__volatility), default=0)
+        if changes_per_hour <= 0:
+            return self.max_interval
+        # Aim for about four polls per expected price change
+        interval = 3600 / (changes_per_hour * 4)
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def poll_due(self):
+        now = time.time()
+        if now < self.__blocked_until:
+            return False
+        if self.__last_poll is not None and 0 <= now - self.__last_poll < self.get_poll_interval():
+            return False
+        self.__refill_tokens(now)
+        return self.__tokens >= len(self.__station_urls)
+
+    def __start_poll(self):
+        now = time.time()
+        self.__refill_tokens(now)
+        self.__last_poll = now
+        self.__tokens -= len(self.__station_urls)
+
+    def __fetch_station_data(self):
+        merged = {}
+        for url in self.__station_urls:
+            try:
+                self.__merge_station_batch(merged, reported_get(self.health, url))
+            except StationThrottled:
+                raise
+            except Exception:
+                pass
+        return self.__read_station_data(merged)
+
+    async def __fetch_station_data_async(self):
+        merged = {}
+        for url in self.__station_urls:
+            try:
+                self.__merge_station_batch(merged, await reported_get_async(self.health, url))
+            except StationThrottled:
+                raise
+            except Exception:
+                pass
+        return self.__read_station_data(merged)
+
+    def get_raw_prices(self):
+        """Returns the last known price of every station as a float or None."""
+        return self.__raw_prices
+
+    def get_cheapest_stations(self, count):
+        """
+        Returns the indices of the cheapest open stations, cheapest first. The ranking
+        is updated with a binary search whenever a price or status changes.
+        """
+        return [i for _, i in self.__ranking[:count]]
+
     def get_station_data(self):
+        self.__start_poll()
         try:
-            response = requests.get(f"{self.base_url_station_info}&ids={",".join(self.station_ids)}")
-            data = response.json()
-            response.close()
-            statuses = [self.__get_station_status(data, sid) for sid in self.station_ids]
-            prices = [self.__get_station_fuel_price(data, sid) for sid in self.station_ids]
+            return self.__fetch_station_data()
+
+        except StationThrottled as e:
+            self.__record_throttle(e.retry_after)
+            return self.__get_fallback_station_data()
 
         except Exception:
-            statuses = [self.__STATION_STATUSES.get(None)] * len(self.station_ids)
-            prices = ["-,--"] * len(self.station_ids)
+            return self.__get_fallback_station_data()
+
+    async def get_station_data_async(self):
+        self.__start_poll()
+        try:
+            return await self.__fetch_station_data_async()
 
-        return statuses, prices
\ No newline at end of file
+        except StationThrottled as e:
+            self.__record_throttle(e.retry_after)
+            return self.__get_fallback_station_data()
+
+        except Exception:
+            return self.__get_fallback_station_data()
+
+    def __get_changes(self, statuses, prices):
+        if self.__all_changed:
+            self.__all_changed = False
+            return statuses, prices, set(self.station_ids)
+        return statuses, prices, self.__changed
+
+    def __get_fallback_changes(self):
+        self.__all_changed = True
+        statuses, prices = self.__get_fallback_station_data()
+        return statuses, prices, set(self.station_ids)
+
+    def get_station_changes(self):
+        """
+        Polls prices only if the polling policy allows it. Returns None if no request
+        was made or the API throttled us (the displayed data stays valid), otherwise
+        statuses, prices and the set of IDs of the stations whose status or price
+        changed since the last poll, so only those rows need to be redrawn.
+        """
+        if not self.poll_due():
+            return None
+
+        self.__start_poll()
+        try:
+            return self.__get_changes(*self.__fetch_station_data())
+        except StationThrottled as e:
+            self.__record_throttle(e.retry_after)
+            return None
+        except Exception:
+            return self.__get_fallback_changes()
+
+    async def get_station_changes_async(self):
+        if not self.poll_due():
+            return None
+
+        self.__start_poll()
+        try:
+            return self.__get_changes(*(await self.__fetch_station_data_async()))
+        except StationThrottled as e:
+            self.__record_throttle(e.retry_after)
+            return None
+        except Exception:
+            return self.__get_fallback_changes()
@@ -1,81 +1,222 @@
-import ntptime, time
+import ntptime, time, socket, struct, machine, json
+import uasyncio as asyncio
+from managers.TimezoneManager import TimezoneManager
 
 class TimeManager:
 
     __WEEKDAYS = ["MONDAY", "TUESDAY", "WEDNESDAY", "THURSDAY", "FRIDAY", "SATURDAY", "SUNDAY"]
+    __SYNC_ERROR = ["Time synchronization failed!",
+                    "This error is caused by the NTP server,",
+                    "probably due to a server outage.",
+                    "System will attempt to sync again."]
+    # Seconds between the NTP epoch (1900) and the epoch used by the port (1970 or 2000)
+    __NTP_DELTA = 3155673600 if time.gmtime(0)[0] == 2000 else 2208988800
+    # Assumed RTC error before a drift has been measured, and the residual error after
+    __UNKNOWN_DRIFT_PPM = 20
+    __RESIDUAL_DRIFT_PPM = 2
+    # Offsets beyond this rate mean the RTC was reset in between, not that it drifted
+    __MAX_PLAUSIBLE_DRIFT_PPM = 500
 
-    def __init__(self):
-        self.tz_offset = 0
+    def __init__(self, timezone=None, state_path="/rtc_drift.json", target_accuracy_ms=1000,
+                 max_error_ms=30000, min_sync_interval=3600, max_sync_interval=604800):
+        self.timezone = timezone if timezone is not None else TimezoneManager("eu", 1)
+        self.__timezone_de = TimezoneManager("eu", 1)
         self.synced = False
+        # RTC drift estimate: measured at every NTP sync, corrected in software in
+        # between and used to space the syncs; kept in state_path across resets
+        self.state_path = state_path
+        self.target_accuracy_ms = target_accuracy_ms
+        self.max_error_ms = max_error_ms
+        self.min_sync_interval = min_sync_interval
+        self.max_sync_interval = max_sync_interval
+        self.last_sync = None
+        self.drift_ppm = None
+        self.drift_change_ppm = None
+        self.__load_drift()
+        # Weekday and date strings stay valid until local midnight or the next DST change
+        self.__weekday = None
+        self.__date = None
+        self.__date_valid_from = 0
+        self.__date_valid_until = 0
+        self.__last_timedate = [None] * 3
 
-    def sync_time(self):
+    def __load_drift(self):
         try:
-            ntptime.settime()  # sets RTC to UTC
-            return "OK", None
+            with open(self.state_path, "r") as f:
+                state = json.load(f)
+            self.last_sync = state["last_sync"]
+            self.drift_ppm = state.get("drift_ppm")
+            self.drift_change_ppm = state.get("drift_change_ppm")
+        except Exception:
+            return
+
+        # The RTC keeps running through machine.reset(); after a power loss it starts at the epoch
+        if time.time() >= self.last_sync:
+            self.synced = True
+
+    def __save_drift(self):
+        try:
+            with open(self.state_path, "w") as f:
+                json.dump({
+                    "last_sync": self.last_sync,
+                    "drift_ppm": self.drift_ppm,
+                    "drift_change_ppm": self.drift_change_ppm
+                }, f)
         except Exception as e:
             print(e)
-            return "2501", ["Time synchronization failed!",
-                            "This error is caused by the NTP server,",
-                            "probably due to a server outage.",
-                            "System will attempt to sync again."]
 
-    def set_timezone(self, offset):
-        self.tz_offset = offset
+    def __get_correction_ms(self, t):
+        if self.drift_ppm is None or self.last_sync is None:
+            return 0
+        return int(self.drift_ppm * (t - self.last_sync) / 1000)
 
-    def get_timestamp(self):
-        return time.gmtime()
-    
-    def __get_localtime(self):
-        t = time.time() + self.tz_offset * 3600
-        return time.localtime(t)
-    
-    def __last_sunday(self, year, month):
-            d = 31
+    def __get_residual_ppm(self):
+        if self.drift_ppm is None:
+            return self.__UNKNOWN_DRIFT_PPM
+        return abs(self.drift_change_ppm or 0) + self.__RESIDUAL_DRIFT_PPM
+
+    def get_estimated_error_ms(self):
+        if not self.synced or self.last_sync is None:
+            return None
+        return self.__get_residual_ppm() * max(0, time.time() - self.last_sync) / 1000
+
+    def get_sync_interval(self):
+        interval = self.target_accuracy_ms * 1000 / self.__get_residual_ppm()
+        return int(max(self.min_sync_interval, min(self.max_sync_interval, interval)))
+
+    def sync_due(self):
+        if not self.synced or self.last_sync is None:
+            return True
+        return not 0 <= time.time() - self.last_sync < self.get_sync_interval()
+
+    def __apply_sync(self, ntp_ms):
+        rtc_ms = time.time_ns() // 1000000
+        ntp_seconds = ntp_ms // 1000
+        if self.last_sync is not None and self.synced:
+            elapsed = ntp_seconds - self.last_sync
+            offset_ms = ntp_ms - rtc_ms
+            if elapsed >= self.min_sync_interval and abs(offset_ms) * 1000 <= elapsed * self.__MAX_PLAUSIBLE_DRIFT_PPM:
+                drift_ppm = offset_ms * 1000 / elapsed
+                if self.drift_ppm is None:
+                    self.drift_ppm = drift_ppm
+                else:
+                    self.drift_change_ppm = drift_ppm - self.drift_ppm
+                    self.drift_ppm = (self.drift_ppm + drift_ppm) / 2
+
+        tm = time.gmtime(ntp_seconds)
+        machine.RTC().datetime((tm[0], tm[1], tm[2], tm[6] + 1, tm[3], tm[4], tm[5], ntp_ms % 1000 * 1000))
+        self.last_sync = ntp_seconds
+        self.synced = True
+        self.__date_valid_until = 0
+        self.__save_drift()
+
+    def __sync_failed(self, e):
+        print(e)
+        # A missed sync is harmless while the corrected clock is still accurate enough
+        error_ms = self.get_estimated_error_ms()
+        if error_ms is not None and error_ms < self.max_error_ms:
+            return "OK", None
+        return "2501", self.__SYNC_ERROR
+
+    def sync_time(self):
+        try:
+            self.__apply_sync(ntptime.time() * 1000)
+            return "OK", None
+        except Exception as e:
+            return self.__sync_failed(e)
+
+    async def sync_time_async(self, timeout_ms=1000):
+        # Same exchange as ntptime.time(), but the socket is polled so other tasks keep running
+        query = bytearray(48)
+        query[0] = 0x1B
+        s = None
+        try:
+            addr = socket.getaddrinfo(ntptime.host, 123)[0][-1]
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(False)
+            s.sendto(query, addr)
+            start = time.ticks_ms()
             while True:
                 try:
-                    tm = time.localtime(time.mktime((year, month, d, 0, 0, 0, 0, 0)))
+                    msg = s.recv(48)
                     break
-                except OverflowError:
-                    d -= 1
+                except OSError:
+                    if time.ticks_diff(time.ticks_ms(), start) > timeout_ms:
+                        raise OSError("NTP request timed out")
+                    await asyncio.sleep_ms(20)
 
-            while True:
-                tm = time.localtime(time.mktime((year, month, d, 0, 0, 0, 0, 0)))
-                if tm[6] == 6:  # Sunday
-                    return d
-                d -= 1
+            seconds, fraction = struct.unpack("!II", msg[40:48])
+            self.__apply_sync((seconds - self.__NTP_DELTA) * 1000 + (fraction * 1000 >> 32))
+            return "OK", None
+        except Exception as e:
+            return self.__sync_failed(e)
+        finally:
+            if s is not None:
+                s.close()
+
+    def get_time(self):
+        """Returns the UTC time in seconds with the estimated RTC drift removed."""
+        t = int(time.time())
+        return t + (self.__get_correction_ms(t) + 500) // 1000
+
+    def set_timezone(self, offset):
+        if isinstance(offset, TimezoneManager):
+            self.timezone = offset
+        else:
+            self.timezone = TimezoneManager("fixed", offset)
+        self.__date_valid_until = 0
+
+    def get_timestamp(self):
+        return time.gmtime(self.get_time())
+    
+    def __update_date_strings(self, t, local):
+        lt = time.localtime(local)
+        self.__weekday = self.__WEEKDAYS[lt[6]]
+        self.__date = "{:02d}.{:02d}.{:04d}".format(lt[2], lt[1], lt[0])
+        next_midnight = t + 86400 - local % 86400
+        self.__date_valid_from = t
+        self.__date_valid_until = min(next_midnight, self.timezone.get_next_transition(t))
     
     def get_timedate(self):
-        t = self.__get_localtime()
+        t = self.get_time()
+        local = t + self.timezone.get_offset(t)
+        # The valid_from check also catches the clock jumping back on an NTP sync
+        if not self.__date_valid_from <= t < self.__date_valid_until:
+            self.__update_date_strings(t, local)
+        minutes = local // 60 % 1440
         return [
-            self.__WEEKDAYS[t[6]],
-            "{:02d}.{:02d}.{:04d}".format(t[2], t[1], t[0]),
-            "{:02d}:{:02d}".format(t[3], t[4])
+            self.__weekday,
+            self.__date,
+            "{:02d}:{:02d}".format(minutes // 60, minutes % 60)
         ]
 
+    def get_timedate_changes(self):
+        """Returns the current weekday/date/time strings and the indices that changed since the last call."""
+        timedate = self.get_timedate()
+        changed = [i for i in range(3) if timedate[i] != self.__last_timedate[i]]
+        self.__last_timedate = timedate
+        return timedate, changed
+
+    def get_ms_to_next_minute(self):
+        now_ms = time.time_ns() // 1000000
+        now_ms += self.__get_correction_ms(now_ms // 1000)
+        return 60000 - now_ms % 60000
+
+    async def run_clock(self, callback):
+        """
+        Calls callback(timedate, changed) once per minute, right after the minute
+        boundary, and only if a field changed. Sleeps in between.
+        """
+        while True:
+            timedate, changed = self.get_timedate_changes()
+            if changed:
+                callback(timedate, changed)
+            # A few ms past the boundary so the wake-up never lands in the old minute
+            await asyncio.sleep_ms(self.get_ms_to_next_minute() + 5)
+
     def get_timezone_de(self) -> int:
         """
         Returns the current timezone offset for Germany (CET=1 or CEST=2).
         Uses European DST rules (last Sunday in March -> last Sunday in October).
         """
-        t = self.__get_localtime()
-        year, month, day, hour = t[0], t[1], t[2], t[3]
-
-        # Last Sundays
-        march_last_sun = self.__last_sunday(year, 3)
-        oct_last_sun = self.__last_sunday(year, 10)
-
-        # DST starts: last Sunday in March at 02:00
-        if (month > 3 and month < 10):
-            return 2  # Summer time
-        elif month == 3:
-            if day > march_last_sun or (day == march_last_sun and hour >= 2):
-                return 2
-            else:
-                return 1
-        elif month == 10:
-            if day < oct_last_sun or (day == oct_last_sun and hour < 3):
-                return 2
-            else:
-                return 1
-        else:
-            return 1  # Winter time
+        return self.__timezone_de.get_offset(self.get_time()) // 3600
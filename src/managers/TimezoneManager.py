@@ -0,0 +1,83 @@
+import time
+
+class TimezoneManager:
+    """
+    Converts UTC to local time with precomputed DST transitions. The UTC instants
+    at which DST starts and ends are calculated once per year, so a lookup is two
+    integer comparisons.
+
+    Rules:
+        "eu": DST from the last Sunday in March to the last Sunday in October, 01:00 UTC
+        "us": DST from the second Sunday in March to the first Sunday in November, 02:00 local
+        "fixed": no DST
+    """
+    RULES = ("eu", "us", "fixed")
+
+    def __init__(self, rule="eu", offset=1):
+        if rule not in self.RULES:
+            raise ValueError("Unknown timezone rule: " + str(rule))
+        self.rule = rule
+        self.standard_offset = int(offset * 3600)
+        self.dst_offset = self.standard_offset + 3600
+        self.__epoch_days = self.__days_from_civil(time.gmtime(0)[0], 1, 1)
+        self.__year_start = 0
+        self.__year_end = 0
+        self.__dst_start = 0
+        self.__dst_end = 0
+
+    def __days_from_civil(self, year, month, day):
+        # Days since 1970-01-01 in the proleptic Gregorian calendar
+        year -= month <= 2
+        era = year // 400
+        year_of_era = year - era * 400
+        day_of_year = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+        day_of_era = year_of_era * 365 + year_of_era // 4 - year_of_era // 100 + day_of_year
+        return era * 146097 + day_of_era - 719468
+
+    def __weekday(self, days):
+        # 1970-01-01 was a Thursday; Monday is 0 like in time.localtime()
+        return (days + 3) % 7
+
+    def __nth_sunday(self, year, month, n):
+        if n > 0:
+            first = self.__days_from_civil(year, month, 1)
+            return first + (6 - self.__weekday(first)) % 7 + 7 * (n - 1)
+
+        if month == 12:
+            last = self.__days_from_civil(year + 1, 1, 1) - 1
+        else:
+            last = self.__days_from_civil(year, month + 1, 1) - 1
+        return last - (self.__weekday(last) + 1) % 7
+
+    def __seconds(self, days, seconds=0):
+        return (days - self.__epoch_days) * 86400 + seconds
+
+    def __compute_year(self, year):
+        self.__year_start = self.__seconds(self.__days_from_civil(year, 1, 1))
+        self.__year_end = self.__seconds(self.__days_from_civil(year + 1, 1, 1))
+        if self.rule == "eu":
+            self.__dst_start = self.__seconds(self.__nth_sunday(year, 3, -1), 3600)
+            self.__dst_end = self.__seconds(self.__nth_sunday(year, 10, -1), 3600)
+        elif self.rule == "us":
+            self.__dst_start = self.__seconds(self.__nth_sunday(year, 3, 2), 7200 - self.standard_offset)
+            self.__dst_end = self.__seconds(self.__nth_sunday(year, 11, 1), 7200 - self.dst_offset)
+        else:
+            self.__dst_start = self.__dst_end = self.__year_start
+
+    def get_offset(self, t):
+        """Returns the UTC offset in seconds that applies at the UTC timestamp t."""
+        if not self.__year_start <= t < self.__year_end:
+            self.__compute_year(time.gmtime(t)[0])
+        if self.__dst_start <= t < self.__dst_end:
+            return self.dst_offset
+        return self.standard_offset
+
+    def get_next_transition(self, t):
+        """Returns the UTC timestamp of the next offset change (or year end) after t."""
+        if not self.__year_start <= t < self.__year_end:
+            self.__compute_year(time.gmtime(t)[0])
+        if t < self.__dst_start:
+            return self.__dst_start
+        if t < self.__dst_end:
+            return self.__dst_end
+        return self.__year_end
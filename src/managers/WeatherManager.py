@@ -1,9 +1,27 @@
-import urequests as requests
+import time
+from managers.HealthManager import reported_get, reported_get_async
 
 class WeatherManager:
-    def __init__(self, lat, long):
+    def __init__(self, lat, long, current_weather_interval=0, cache=None, forecast_ttl=3600, forecast_max_age=21600,
+                 health=None):
         self.base_url_current_weather = f"https://api.brightsky.dev/current_weather?lat={lat}&lon={long}"
         self.base_url_weather = f"https://api.brightsky.dev/weather?lat={lat}&lon={long}"
+        # 0 keeps the device on the day forecast alone; a positive number of seconds
+        # additionally refines temperature and icon from /current_weather at that cadence
+        self.current_weather_interval = current_weather_interval
+        self.__current_weather = None
+        self.__current_weather_attempted = None
+        # The forecast is kept in RAM and, if a CacheManager is given, persisted per (lat, lon, date)
+        self.cache = cache
+        self.forecast_ttl = forecast_ttl
+        self.forecast_max_age = forecast_max_age
+        self.__forecast_prefix = "forecast_{}_{}_".format(
+            "{:.4f}".format(lat).replace(".", "_"), "{:.4f}".format(long).replace(".", "_")
+        )
+        self.__forecast_key = None
+        self.__forecast = None
+        # Optional HealthManager that learns the connectivity verdict from these requests
+        self.health = health
 
     def __round_half_up(self, x):
             if abs(x)%1<.5:
@@ -17,6 +35,24 @@ class WeatherManager:
 
         except Exception:
             return "----"
+
+    def __get_forecast_temperature(self, data, hour, minute):
+        try:
+            current = data["weather"][hour]["temperature"]
+            if current is None:
+                return "N/A"
+
+            try:
+                following = data["weather"][hour + 1]["temperature"]
+            except Exception:
+                following = None
+
+            if following is not None:
+                current += (following - current) * minute / 60
+            return f"{self.__round_half_up(current)}`C"
+
+        except Exception:
+            return "----"
         
     def __get_rain_probability(self, data, hour):
         try:
@@ -35,7 +71,7 @@ class WeatherManager:
             
             min_temp = self.__round_half_up(min(data))
             max_temp = self.__round_half_up(max(data))
-            if current_temperature is not "----":
+            if current_temperature not in ("----", "N/A"):
                 current_temperature = int(current_temperature[:-2])
                 min_temp = current_temperature if current_temperature < min_temp else min_temp
                 max_temp = current_temperature if current_temperature > max_temp else max_temp
@@ -53,27 +89,163 @@ class WeatherManager:
         except Exception:
             return "unknown"
 
-    def get_weather_data(self, timestamp):
-        date = "{:04d}-{:02d}-{:02d}".format(
-            timestamp[0], timestamp[1], timestamp[2]
-        )
+    def __get_forecast_icon(self, data, hour):
         try:
-            response = requests.get(self.base_url_current_weather)
-            data = response.json()
-            response.close()
-            current_temperature = self.__get_current_temperature(data)
-            weather_icon_name = self.__get_weather_icon(data)
+            data = data["weather"][hour]["icon"]
+            return str(data) if data is not None else "unknown"
+
         except Exception:
-            current_temperature = "----"
-            weather_icon_name = "unknown"
+            return "unknown"
 
+    def __current_weather_due(self):
+        due = self.current_weather_interval > 0 and (
+            self.__current_weather_attempted is None
+            or not 0 <= time.time() - self.__current_weather_attempted < self.current_weather_interval
+        )
+        if due:
+            # Failed attempts count too, so a broken endpoint is not requested on every refresh
+            self.__current_weather_attempted = time.time()
+        return due
+
+    def __read_current_weather(self, response):
+        data = response.json()
+        response.close()
+        current_temperature = self.__get_current_temperature(data)
+        weather_icon_name = self.__get_weather_icon(data)
+        if current_temperature != "----":
+            self.__current_weather = (current_temperature, weather_icon_name)
+        else:
+            self.__current_weather = None
+
+    def __get_header(self, response, name):
         try:
-            response = requests.get(f"{self.base_url_weather}&date={date}")
+            for key, value in response.headers.items():
+                if key.lower() == name:
+                    return value
+        except Exception:
+            pass
+        return None
+
+    def __get_forecast_age(self, entry):
+        age = time.time() - entry.get("fetched", 0)
+        # Before the first NTP sync the RTC can lag behind the stored fetch time
+        return age if age >= 0 else None
+
+    def __load_forecast(self, key):
+        if self.__forecast_key == key:
+            return self.__forecast
+
+        entry = None
+        if self.cache is not None:
+            entry = self.cache.load(key)
+            for old_key in self.cache.keys(self.__forecast_prefix):
+                if old_key != key:
+                    self.cache.remove(old_key)
+
+        self.__forecast_key = key
+        self.__forecast = entry
+        return entry
+
+    def __save_forecast(self, key, data, etag, last_modified):
+        entry = {
+            "fetched": time.time(),
+            "etag": etag,
+            "last_modified": last_modified,
+            "data": data
+        }
+        self.__forecast_key = key
+        self.__forecast = entry
+        if self.cache is not None:
+            self.cache.save(key, entry)
+        return entry
+
+    def __prepare_forecast_request(self, date):
+        key = self.__forecast_prefix + date
+        entry = self.__load_forecast(key)
+        age = self.__get_forecast_age(entry) if entry is not None else None
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        fresh = age is not None and age < self.forecast_ttl
+        return key, entry, age, headers, fresh
+
+    def __read_forecast(self, key, entry, response):
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            entry = self.__save_forecast(key, entry["data"], entry.get("etag"), entry.get("last_modified"))
+        elif response.status_code != 200:
+            # Error bodies are never cached, the caller falls back to the last good forecast
+            response.close()
+            raise OSError("Forecast request failed: " + str(response.status_code))
+        else:
             data = response.json()
+            etag = self.__get_header(response, "etag")
+            last_modified = self.__get_header(response, "last-modified")
             response.close()
-            rain_probability = self.__get_rain_probability(data, timestamp[3])
-            min, max = self.__get_min_max_temperature(data, current_temperature)
-        except Exception:
-            rain_probability, min, max = "----"
+            entry = self.__save_forecast(key, data, etag, last_modified)
+        return entry["data"]
+
+    def __fallback_forecast(self, entry, age):
+        if entry is not None and (age is None or age < self.forecast_max_age):
+            return entry["data"]
+        return None
+
+    def __get_date(self, timestamp):
+        return "{:04d}-{:02d}-{:02d}".format(
+            timestamp[0], timestamp[1], timestamp[2]
+        )
+
+    def __build_weather_data(self, data, timestamp):
+        current_temperature = self.__get_forecast_temperature(data, timestamp[3], timestamp[4])
+        weather_icon_name = self.__get_forecast_icon(data, timestamp[3])
+        if self.current_weather_interval > 0 and self.__current_weather is not None:
+            current_temperature, weather_icon_name = self.__current_weather
+
+        rain_probability = self.__get_rain_probability(data, timestamp[3])
+        min, max = self.__get_min_max_temperature(data, current_temperature)
+
+        return [current_temperature, rain_probability, min, max], weather_icon_name
+
+    def get_weather_data(self, timestamp):
+        date = self.__get_date(timestamp)
+        key, entry, age, headers, fresh = self.__prepare_forecast_request(date)
+        if fresh:
+            data = entry["data"]
+        else:
+            try:
+                response = reported_get(self.health, f"{self.base_url_weather}&date={date}", headers)
+                data = self.__read_forecast(key, entry, response)
+            except Exception:
+                data = self.__fallback_forecast(entry, age)
+
+        if self.__current_weather_due():
+            try:
+                self.__read_current_weather(reported_get(self.health, self.base_url_current_weather))
+            except Exception:
+                self.__current_weather = None
+
+        return self.__build_weather_data(data, timestamp)
+
+    async def get_weather_data_async(self, timestamp):
+        date = self.__get_date(timestamp)
+        key, entry, age, headers, fresh = self.__prepare_forecast_request(date)
+        if fresh:
+            data = entry["data"]
+        else:
+            try:
+                response = await reported_get_async(self.health, f"{self.base_url_weather}&date={date}", headers)
+                data = self.__read_forecast(key, entry, response)
+            except Exception:
+                data = self.__fallback_forecast(entry, age)
+
+        if self.__current_weather_due():
+            try:
+                self.__read_current_weather(await reported_get_async(self.health, self.base_url_current_weather))
+            except Exception:
+                self.__current_weather = None
 
-        return [current_temperature, rain_probability, min, max], weather_icon_name
\ No newline at end of file
+        return self.__build_weather_data(data, timestamp)
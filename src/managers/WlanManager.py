@@ -1,29 +1,160 @@
-import network, time, socket
+import network, time, json
+from managers.HealthManager import HealthManager
 
 class WlanManager:
-    def __init__(self):
+    def __init__(self, cache_path="/wlan_cache.json", fast_connect_timeout_ms=4000, reuse_ip=False, lease_time=43200,
+                 health=None):
         self.wlan = network.WLAN(network.STA_IF)
         self.was_connected_before = False
-        if self.wlan.active():
-            self.wlan.active(False)
-            time.sleep(5)
+        self.health = health if health is not None else HealthManager()
+        # The last good BSSID, channel and IP configuration allow a directed connect
+        # without a scan (and, with reuse_ip, without DHCP) before falling back
+        self.cache_path = cache_path
+        self.fast_connect_timeout_ms = fast_connect_timeout_ms
+        self.reuse_ip = reuse_ip
+        self.lease_time = lease_time
+        self.__cache = self.__load_cache()
+        self.__ssid = None
+        self.__psk = None
+        self.__bssid = None
+        self.__channel = None
+        self.__fast_connect_started = None
+        self.__save_pending = False
+        self.__dhcp = False
+        if self.wlan.active() and not self.wlan.isconnected():
+            # A half-finished attempt from before a reset is cancelled instead of power-cycling the radio
+            try:
+                self.wlan.disconnect()
+            except OSError:
+                pass
         
         self.wlan.active(True)
 
+    def __load_cache(self):
+        try:
+            with open(self.cache_path, "r") as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def __save_cache(self):
+        bssid = self.__bssid
+        if bssid is None:
+            return
+        ifconfig = list(self.wlan.ifconfig())
+        cache = self.__cache or {}
+        # Every DHCP connect renews the lease, even if it handed out the same address
+        if (
+            not self.__dhcp and cache.get("ssid") == self.__ssid and cache.get("bssid") == bssid
+            and cache.get("ifconfig") == ifconfig and cache.get("channel") == self.__channel
+        ):
+            return
+
+        self.__cache = {
+            "ssid": self.__ssid,
+            "bssid": bssid,
+            "channel": self.__channel,
+            "ifconfig": ifconfig,
+            "leased": time.time() if self.__dhcp else cache.get("leased", 0)
+        }
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump(self.__cache, f)
+        except Exception as e:
+            print(e)
+
+    def __scan_connect(self):
+        self.__fast_connect_started = None
+        self.__dhcp = True
+        try:
+            self.wlan.ifconfig("dhcp")
+        except Exception:
+            pass
+
+        self.__bssid = None
+        self.__channel = None
+        try:
+            networks = [n for n in self.wlan.scan() if n[0].decode() == self.__ssid]
+        except Exception:
+            networks = []
+        if networks:
+            best = max(networks, key=lambda n: n[3])
+            self.__bssid = best[1].hex()
+            self.__channel = best[2]
+            self.wlan.connect(self.__ssid, self.__psk, bssid=best[1])
+        else:
+            self.wlan.connect(self.__ssid, self.__psk)
+
+    def __fast_connect(self):
+        cache = self.__cache
+        self.__bssid = cache["bssid"]
+        self.__channel = cache.get("channel")
+        if self.__channel:
+            try:
+                self.wlan.config(channel=self.__channel)
+            except Exception:
+                pass
+        self.__dhcp = True
+        if self.reuse_ip and cache.get("ifconfig") and 0 <= time.time() - cache.get("leased", 0) < self.lease_time:
+            self.wlan.ifconfig(tuple(cache["ifconfig"]))
+            self.__dhcp = False
+        self.__fast_connect_started = time.ticks_ms()
+        self.wlan.connect(self.__ssid, self.__psk, bssid=bytes.fromhex(self.__bssid))
+
+    def __check_fast_connect(self):
+        if self.wlan.isconnected():
+            self.__fast_connect_started = None
+            if self.__save_pending:
+                self.__save_pending = False
+                self.__save_cache()
+            return True
+
+        if (
+            self.__fast_connect_started is not None
+            and time.ticks_diff(time.ticks_ms(), self.__fast_connect_started) > self.fast_connect_timeout_ms
+        ):
+            try:
+                self.wlan.disconnect()
+            except OSError:
+                pass
+            self.__scan_connect()
+        return False
+
     def connect(self, ssid, psk):
         if self.wlan.isconnected():
             return
 
-        self.wlan.connect(ssid, psk)
+        self.__ssid = ssid
+        self.__psk = psk
+        self.__save_pending = True
+        cache = self.__cache
+        if cache is not None and cache.get("ssid") == ssid and cache.get("bssid"):
+            try:
+                self.__fast_connect()
+                return
+            except Exception as e:
+                print(e)
+
+        self.__scan_connect()
+
+    def reconnect(self):
+        """Starts a new connection attempt with the last credentials, e.g. after a WLAN blip."""
+        self.health.invalidate()
+        if self.__ssid is not None:
+            try:
+                self.wlan.disconnect()
+            except OSError:
+                pass
+            self.connect(self.__ssid, self.__psk)
 
     def is_connected_boolean(self):
-        if self.wlan.isconnected():
+        if self.__check_fast_connect():
             return True
         else:
             return False
 
     def is_connected(self):
-        if self.wlan.isconnected():
+        if self.__check_fast_connect():
             self.was_connected_before = True
             return "OK", None
         elif self.was_connected_before:
@@ -41,12 +172,9 @@ class WlanManager:
         return self.wlan.ifconfig()[0] if self.wlan.isconnected() else None
 
     def device_online(self):
-        try:
-            addr = socket.getaddrinfo("1.1.1.1", 53)[0][-1]
-            socket.socket().connect(addr)
+        if self.wlan.isconnected() and self.health.is_online():
             return "OK", None
-        
-        except Exception as e:
+        else:
             return "2401", ["No internet conenction!",
                         "Although your WLAN works, there is no",
                         "internet connection. Please restart your",
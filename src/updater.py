@@ -1,14 +1,164 @@
-import machine, os, tarfile, hashlib, json, shutil
+import machine, os, sys, tarfile, hashlib, json, shutil, binascii, struct, time, random
 import urequests as requests
+import uasyncio as asyncio
 
 OTA_API_URL = "https://api.github.com/repos/smolinde/ota-test/releases/latest"
+# Site-local mirror (tools/ota_mirror.py), e.g. "http://192.168.1.10:8000"; None uses GitHub only
+OTA_MIRROR_URL = None
+# Trimmed release metadata with its ETag, so later polls are conditional and usually
+# answered with a small 304 Not Modified. The requests are unauthenticated, so GitHub
+# still counts a 304 against the rate limit; the poll interval keeps within it
+RELEASE_CACHE_PATH = "/release.json"
+CHECK_INTERVAL = 86400
+# Assets are streamed from the socket to flash in chunks of this size
+CHUNK_SIZE = 4096
+# A partial download is checkpointed in <archive>.part every RESUME_BLOCK bytes with the
+# hash of each completed block, so it resumes with an HTTP Range request after a drop
+RESUME_BLOCK = 32768
+DOWNLOAD_RETRIES = 5
+RETRY_BACKOFF_BASE = 2
+RETRY_BACKOFF_MAX = 60
+# Release manifest of the installed files: {"version", "files": {path: {"sha256", "size"}}, "archives"}
+MANIFEST_NAME = "manifest.json"
+UPDATE_MANIFEST_PATH = "/updates/" + MANIFEST_NAME
+# Versions are installed side by side in two slots. boot.py reads BOOT_STATE_PATH and starts
+# the active slot; a new slot stays pending until the application confirms it is healthy
+SLOTS = ("/slot_a", "/slot_b")
+BOOT_STATE_PATH = "/boot.json"
+# Device state that outlives a version stays at the root, only "version" belongs to the slot
+STATE_FILES = ("rtc_drift.json", "wlan_cache.json")
+# Release archives ship the application as main_NEW.py for the old rename-based install
+SLOT_NAMES = {"main_NEW.py": "main.py"}
+INSTALLED_NAMES = {"main_NEW.py": ("main_OLD.py", "main.py"), "updater.py": ("updater.py", "main.py")}
+# Delta archives may carry a binary patch for a changed file under this prefix instead of
+# the file itself. A patch is PATCH_MAGIC followed by opcodes: PATCH_COPY <offset> <length>
+# copies bytes of the old file, PATCH_INSERT <length> <data> inserts literal bytes and
+# PATCH_END terminates it. Numbers are little-endian uint32.
+PATCH_PREFIX = ".patch/"
+PATCH_DIR = "/updates/"
+PATCH_MAGIC = b"OTAP"
+PATCH_END = b"\x00"
+PATCH_COPY = b"\x01"
+PATCH_INSERT = b"\x02"
+
+class GitHubSource:
+    """The latest release of a GitHub repository, read from the releases API."""
+
+    def __init__(self, api_url=None):
+        self.url = api_url or OTA_API_URL
+
+    def read_release(self, data):
+        return str(data["tag_name"]), {asset["name"]: asset["browser_download_url"] for asset in data["assets"]}
+
+class MirrorSource:
+    """
+    An HTTP mirror with content-addressed storage. latest.json holds the tag and the
+    SHA-256 of every asset of the release, and each asset is served at sha256/<hash>.
+    """
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.url = self.base_url + "/latest.json"
+
+    def read_release(self, data):
+        return str(data["tag_name"]), {name: f"{self.base_url}/sha256/{sha}" for name, sha in data["assets"].items()}
 
 class UpdateManager:
 
-    def __init__(self):
-        pass
+    def __init__(self, chunk_size=CHUNK_SIZE, check_interval=CHECK_INTERVAL, check_jitter=0.05, sources=None):
+        # Sources are tried in order, so a mirror listed first is preferred over GitHub
+        if sources is None:
+            sources = [GitHubSource()]
+            if OTA_MIRROR_URL:
+                sources.insert(0, MirrorSource(OTA_MIRROR_URL))
+        self.sources = sources
+        self.__source_index = 0
+        self.__buffer = bytearray(chunk_size)
+        self.__verified = None
+        self.check_interval = check_interval
+        self.check_jitter = check_jitter
+        # {"next_check": t, "releases": {source url: {"etag", "tag_name", "assets"}}}
+        self.__cache = load_json(RELEASE_CACHE_PATH) or {}
+        if "releases" not in self.__cache:
+            self.__cache = {"releases": {}}
+        self.__release = None
+        self.__release_fresh = False
+
+    def __get_phase(self):
+        # Every device polls at its own offset into the interval, derived from its
+        # unique ID, so a fleet behind one NAT never polls at the same moment
+        digest = hashlib.sha256(machine.unique_id()).digest()
+        return int.from_bytes(digest[:4], "big") % self.check_interval
+
+    def __get_next_check(self, now):
+        phase = self.__get_phase()
+        next_check = ((now - phase) // self.check_interval + 1) * self.check_interval + phase
+        return next_check + int(random.random() * self.check_interval * self.check_jitter)
+
+    def check_due(self):
+        """Returns True once this device's next randomized release check is reached."""
+        next_check = self.__cache.get("next_check")
+        if next_check is None:
+            return True
+        now = time.time()
+        # A clock that jumped backwards would otherwise postpone the check indefinitely
+        if next_check - now > self.check_interval * (1 + self.check_jitter):
+            return True
+        return now >= next_check
+
+    def __save_release(self):
+        try:
+            with open(RELEASE_CACHE_PATH + ".tmp", "w") as f:
+                json.dump(self.__cache, f)
+            os.rename(RELEASE_CACHE_PATH + ".tmp", RELEASE_CACHE_PATH)
+        except OSError as e:
+            print(e)
+
+    def __fetch_from(self, source):
+        headers = {}
+        # Every source has its own ETag, so a fallback does not invalidate the other's
+        cached = self.__cache["releases"].get(source.url)
+        if cached is not None and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        response = requests.get(source.url, headers=headers)
+        try:
+            if response.status_code == 304 and "If-None-Match" in headers:
+                return cached
+            if response.status_code != 200:
+                raise OSError("HTTP " + str(response.status_code))
+            tag_name, assets = source.read_release(response.json())
+            return {
+                "etag": self.__get_header(response, "ETag"),
+                "tag_name": tag_name,
+                "assets": assets
+            }
+        finally:
+            response.close()
+
+    def __fetch_release(self, start=0):
+        if self.__release_fresh and start <= self.__source_index:
+            return self.__release
+
+        for i in range(start, len(self.sources)):
+            try:
+                release = self.__fetch_from(self.sources[i])
+                break
+            except Exception as e:
+                print(e)
+        else:
+            raise OSError("No update source available")
+
+        self.__cache["releases"][self.sources[i].url] = release
+        self.__cache["next_check"] = self.__get_next_check(int(time.time()))
+        self.__release = release
+        self.__release_fresh = True
+        self.__source_index = i
+        self.__save_release()
+        return release
 
     def update_available(self):
+        # Every check asks the sources again; only the download that follows reuses the answer
+        self.__release_fresh = False
         current_version = "v0.0.0"
         try:
             with open("version", "r") as f:
@@ -18,31 +168,230 @@ class UpdateManager:
                 f.write("v0.0.0")
 
         try:
-            response = requests.get(OTA_API_URL)
-            data = response.json()
-            response.close()
-            return current_version, str(data["tag_name"])
+            tag_name = self.__fetch_release()["tag_name"]
         except:
             return None, None
 
-    def download_update(self):
+        # A version that was rolled back at boot is not installed again
+        if tag_name == get_boot_state().get("failed_version"):
+            return current_version, current_version
+        return current_version, tag_name
+
+    def __hexdigest(self, sha256):
+        return binascii.hexlify(sha256.digest()).decode()
+
+    def __get_header(self, response, name):
+        name = name.lower()
+        for key, value in response.headers.items():
+            if key.lower() == name:
+                return value
+        return None
+
+    def __save_progress(self, path, expected_sha, blocks):
+        with open(path + ".part", "w") as f:
+            json.dump({"sha256": expected_sha, "blocks": blocks}, f)
+
+    def __remove_progress(self, path):
+        # Downloads shorter than one block never write a checkpoint
         try:
-            os.mkdir("updates")
-        except:
-            raise Exception("Failed to create updates folder!")
+            os.remove(path + ".part")
+        except OSError:
+            pass
 
+    def __resume(self, path, expected_sha):
+        # Re-hashes the part of a previous download whose blocks still match the
+        # checkpoint and returns the hashes of those blocks with the running hash;
+        # the download continues right after them
+        sha256 = hashlib.sha256()
+        progress = load_json(path + ".part")
+        if progress is None or progress.get("sha256") != expected_sha:
+            return [], sha256
+
+        view = memoryview(self.__buffer)
+        blocks = progress["blocks"]
         try:
-            response = requests.get(OTA_API_URL)
-            data = response.json()
+            with open(path, "rb") as f:
+                for i, expected in enumerate(blocks):
+                    block = hashlib.sha256()
+                    remaining = RESUME_BLOCK
+                    while remaining:
+                        n = f.readinto(view[:min(remaining, len(self.__buffer))])
+                        if not n:
+                            break
+                        block.update(view[:n])
+                        sha256.update(view[:n])
+                        remaining -= n
+                        yield 0
+                    if remaining or self.__hexdigest(block) != expected:
+                        # The running hash already saw the bad block, so start over from the good prefix
+                        self.__save_progress(path, expected_sha, blocks[:i])
+                        return (yield from self.__resume(path, expected_sha))
+        except OSError:
+            return [], hashlib.sha256()
+        return blocks, sha256
+
+    def __stream_asset(self, url, path, expected_sha=None, size=None):
+        """
+        Copies the response body to path through one reusable buffer and hashes it
+        on the way, so neither the asset nor a second read pass ever needs the heap.
+        With expected_sha the download is checkpointed and resumed where a previous
+        attempt stopped. Raises OSError if the connection drops before the end.
+        """
+        view = memoryview(self.__buffer)
+        if expected_sha:
+            blocks, sha256 = yield from self.__resume(path, expected_sha)
+        else:
+            blocks, sha256 = [], hashlib.sha256()
+        offset = len(blocks) * RESUME_BLOCK
+        if size is not None and offset >= size:
+            self.__remove_progress(path)
+            return self.__hexdigest(sha256)
+
+        response = requests.get(url, headers={"Range": f"bytes={offset}-"} if offset else {})
+        try:
+            if offset and response.status_code == 200:
+                # The server ignored the range and sends the whole asset
+                sha256, blocks, offset = hashlib.sha256(), [], 0
+            elif response.status_code == 416:
+                # The checkpoint does not fit the asset on the server; the next attempt starts over
+                self.__remove_progress(path)
+                raise OSError("Range not satisfiable")
+            elif offset and response.status_code == 206:
+                content_range = self.__get_header(response, "Content-Range") or ""
+                if not content_range.startswith(f"bytes {offset}-"):
+                    raise OSError("Unexpected range: " + content_range)
+            elif response.status_code != 200:
+                raise OSError("HTTP " + str(response.status_code))
+
+            if size is None:
+                length = self.__get_header(response, "Content-Length")
+                size = offset + int(length) if length is not None else None
+
+            with open(path, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                block = hashlib.sha256()
+                in_block = 0
+                while True:
+                    n = response.raw.readinto(view[:min(len(self.__buffer), RESUME_BLOCK - in_block)])
+                    if not n:
+                        break
+                    sha256.update(view[:n])
+                    block.update(view[:n])
+                    f.write(view[:n])
+                    offset += n
+                    in_block += n
+                    if in_block == RESUME_BLOCK and expected_sha:
+                        f.flush()
+                        blocks.append(self.__hexdigest(block))
+                        self.__save_progress(path, expected_sha, blocks)
+                        block = hashlib.sha256()
+                        in_block = 0
+                    yield 0
+        finally:
+            response.close()
+
+        if size is not None and offset < size:
+            raise OSError(f"Connection dropped at {offset} of {size} bytes")
+        if expected_sha:
+            self.__remove_progress(path)
+        return self.__hexdigest(sha256)
+
+    def __select_archive(self, manifest, installed):
+        # Archives come as source form and, if the release was compiled, as bytecode form
+        archives = manifest["archives"]
+        form = "_mpy" if "full_mpy" in archives and mpy_compatible(manifest.get("mpy")) else ""
+        # A delta archive holds only the files that changed since installed["version"]
+        if installed is not None:
+            delta = archives.get("deltas" + form, {}).get(installed.get("version"))
+            if delta is not None:
+                return delta
+        return archives["full" + form]
+
+    def __clean_updates(self, keep):
+        # Anything but the archive being downloaded is left over from another release
+        for entry in os.listdir("/updates"):
+            if entry not in keep:
+                if os.stat("/updates/" + entry)[0] & 0x4000:
+                    shutil.rmtree("/updates/" + entry)
+                else:
+                    os.remove("/updates/" + entry)
+
+    def __download_archive(self, urls, name, expected_sha, size=None):
+        # The checksum is known before the download, so the archive is
+        # verified the moment its last chunk arrives
+        sha_name = name.replace(".tar.gz", ".sha256")
+        self.__clean_updates((MANIFEST_NAME, name, name + ".part", sha_name))
+        with open("/updates/" + sha_name, "w") as f:
+            f.write(expected_sha)
+
+        tar_path = "/updates/" + name
+        for attempt in range(DOWNLOAD_RETRIES):
+            try:
+                digest = yield from self.__stream_asset(urls[name], tar_path, expected_sha, size)
+                break
+            except OSError as e:
+                print(e)
+                if attempt == DOWNLOAD_RETRIES - 1:
+                    raise
+                delay = min(RETRY_BACKOFF_BASE << attempt, RETRY_BACKOFF_MAX)
+                yield delay / 2 + random.random() * delay / 2
+
+        if digest != expected_sha:
+            os.remove(tar_path)
+            return "2602", [
+                "Update Verification Failed!",
+                "The downloaded update does not match",
+                "its checksum. The system will attempt",
+                "to download the update in 24 hours!"]
+
+        self.__verified = tar_path
+        return "OK", None
+
+    def __download_release(self, urls):
+        if MANIFEST_NAME in urls:
+            response = requests.get(urls[MANIFEST_NAME])
+            if response.status_code != 200:
+                response.close()
+                raise OSError("HTTP " + str(response.status_code))
+            manifest = response.json()
             response.close()
-            for asset in data["assets"]:
-                if asset["name"].endswith('.tar.gz') or asset["name"].endswith('.sha256'):
-                    response = requests.get(asset["browser_download_url"])
-                    with open("/updates/"+{asset["name"]}, "wb") as f:
-                        f.write(response.content)
-                    response.close()
+            manifest["files"] = select_files(manifest)
+            with open(UPDATE_MANIFEST_PATH, "w") as f:
+                json.dump(manifest, f)
+            archive = self.__select_archive(manifest, load_json(get_active_slot() + "/" + MANIFEST_NAME))
+            return (yield from self.__download_archive(urls, archive["name"], archive["sha256"], archive.get("size")))
 
-            return "OK", None
+        # Releases without a manifest only ship the full tarball and its checksum
+        sha_name = next(name for name in urls if name.endswith(".sha256"))
+        tar_name = next(name for name in urls if name.endswith(".tar.gz"))
+        response = requests.get(urls[sha_name])
+        if response.status_code != 200:
+            response.close()
+            raise OSError("HTTP " + str(response.status_code))
+        expected_sha = response.text.split()[0]
+        response.close()
+        return (yield from self.__download_archive(urls, tar_name, expected_sha))
+
+    def __download(self):
+        self.__verified = None
+        try:
+            os.mkdir("/updates")
+        except OSError:
+            # Left by an earlier attempt, possibly with a partial download to resume
+            if not os.stat("/updates")[0] & 0x4000:
+                raise Exception("Failed to create updates folder!")
+
+        try:
+            # Reuses the release that update_available() just checked
+            release = self.__fetch_release()
+            while True:
+                try:
+                    return (yield from self.__download_release(release["assets"]))
+                except OSError as e:
+                    # Partial downloads are keyed by their hash, so the next source,
+                    # e.g. GitHub after the mirror went away, resumes where this one stopped
+                    print(e)
+                    release = self.__fetch_release(self.__source_index + 1)
 
         except:
             return "2601", [
@@ -51,73 +400,387 @@ class UpdateManager:
                 "the update. The system will attempt to",
                 "download the update in 24 hours again!"]
 
-    def verify_update(self):
-        files = os.listdir("updates")
-        sha_path = next(("updates/" + f for f in files if f.endswith(".sha256")), None)
-        tar_path = next(("updates/" + f for f in files if f.endswith(".tar.gz")), None)
+    def download_update(self):
+        return run_steps(self.__download())
+
+    async def download_update_async(self):
+        """Like download_update(), but lets other tasks run between chunks and during retry backoff."""
+        return await run_steps_async(self.__download())
+
+    def __verify(self):
+        files = os.listdir("/updates")
+        sha_path = next(("/updates/" + f for f in files if f.endswith(".sha256")), None)
+        tar_path = next(("/updates/" + f for f in files if f.endswith(".tar.gz")), None)
         if not sha_path or not tar_path:
             raise Exception("Missing update files!")
 
+        # download_update() already hashed the tarball while streaming it
+        if self.__verified == tar_path:
+            return
+
         with open(sha_path, 'r') as f:
             expected_sha = f.read().split()[0]
 
         sha256 = hashlib.sha256()
+        view = memoryview(self.__buffer)
         with open(tar_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(8192), b''):
-                sha256.update(chunk)
+            while True:
+                n = f.readinto(self.__buffer)
+                if not n:
+                    break
+                sha256.update(view[:n])
+                yield 0
 
-        if sha256.hexdigest() != expected_sha:
+        if self.__hexdigest(sha256) != expected_sha:
             raise Exception("Update verification failed!")
+
+    def verify_update(self):
+        run_steps(self.__verify())
+
+    def __install(self):
+        yield from self.__verify()
+        activate_slot((yield from stage_update(find_update_file())))
+
+    def install_update(self, before_reset=None):
+        """
+        Stages the verified update next to the running version, which keeps running
+        meanwhile, then switches over with a single reset. before_reset is called
+        right before it, e.g. to save state the application buffers in RAM.
+        """
+        run_steps(self.__install())
+        if before_reset is not None:
+            before_reset()
+        machine.reset()
+
+    async def install_update_async(self, before_reset=None):
+        """Like install_update(), but lets other tasks run between the chunks of every file."""
+        await run_steps_async(self.__install())
+        if before_reset is not None:
+            before_reset()
+        machine.reset()
+
+    def update_pending(self):
+        return bool(get_boot_state().get("pending"))
+
+    def confirm_update(self):
+        """
+        Called by the application once it is healthy after an update. Until then
+        boot.py rolls back to the previous slot after MAX_BOOT_ATTEMPTS boots.
+        """
+        state = get_boot_state()
+        if not state.get("pending"):
+            return
+        state["pending"] = False
+        state["attempts"] = 0
+        save_json(BOOT_STATE_PATH, state)
+        try:
+            shutil.rmtree("/updates")
+        except OSError:
+            pass
         
 
-def main():
-    update_file = None
-    for entry in os.listdir("/"):
-        if entry in ["lib", "updates", "main.py"]:
-            continue
+def run_steps(steps):
+    """
+    Runs a step generator to completion and returns its result. Steps yield between
+    chunks, with the number of seconds to wait before continuing (0 for none).
+    """
+    try:
+        while True:
+            delay = next(steps)
+            if delay:
+                time.sleep(delay)
+    except StopIteration as e:
+        return e.args[0] if e.args else None
+
+async def run_steps_async(steps):
+    """Like run_steps(), but lets other uasyncio tasks run at every step."""
+    try:
+        while True:
+            await asyncio.sleep(next(steps))
+    except StopIteration as e:
+        return e.args[0] if e.args else None
+
+def load_json(path):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def save_json(path, data):
+    with open(path + ".tmp", "w") as f:
+        json.dump(data, f)
+    os.rename(path + ".tmp", path)
+
+def get_boot_state():
+    return load_json(BOOT_STATE_PATH) or {}
+
+def get_active_slot():
+    # "" is the root folder of a device that was installed before slots existed
+    return get_boot_state().get("active") or ""
 
+def slot_path(slot, name):
+    return slot + "/" + SLOT_NAMES.get(name, name)
+
+def find_installed(slot, name):
+    # While the old rename-based install runs, the application is main_OLD.py and
+    # the updater is main.py
+    for candidate in INSTALLED_NAMES.get(name, (name,)):
+        path = slot + "/" + candidate
         try:
-            if os.stat("/" + entry)[0] & 0x4000:
-                shutil.rmtree("/" + entry)
-            else:
-                os.remove("/" + entry)
-        except:
-            raise Exception("Failed to wipe the root storage!")
+            os.stat(path)
+            return path
+        except OSError:
+            pass
+    return slot + "/" + name
 
-    for f in os.listdir("updates"):
-        if f.endswith(".tar.gz"):
-            update_file = f"/updates/{f}"
-            break
+def mpy_compatible(info):
+    # The low byte of sys.implementation._mpy is the bytecode version this firmware loads;
+    # the sub-version only matters for native code, which releases do not contain
+    mpy = getattr(sys.implementation, "_mpy", None)
+    if info is None or mpy is None:
+        return False
+    return mpy & 0xFF == info["version"]
+
+def select_files(manifest):
+    """
+    Compiled releases list modules both as precompiled .mpy and as .py source. Keeps the
+    .mpy of a module if this firmware can load its bytecode and the source otherwise,
+    which are the files of the archive form __select_archive() picks.
+    """
+    files = manifest["files"]
+    use_mpy = mpy_compatible(manifest.get("mpy"))
+    selected = {}
+    for name, entry in files.items():
+        if name.endswith(".mpy"):
+            if use_mpy:
+                selected[name] = entry
+        elif not (use_mpy and name.endswith(".py") and name[:-3] + ".mpy" in files):
+            selected[name] = entry
+    return selected
+
+def get_changes(manifest, installed):
+    """Returns the paths whose hash differs from the installed manifest."""
+    installed_files = installed["files"]
+    return [path for path, entry in manifest["files"].items() if installed_files.get(path, {}).get("sha256") != entry["sha256"]]
+
+def _make_dirs(path, created):
+    # created remembers every directory made so each path prefix is touched once
+    if path in created:
+        return
+    parent = path.rpartition("/")[0]
+    if parent:
+        _make_dirs(parent, created)
+    try:
+        os.mkdir(path)
+    except OSError:
+        pass
+    created.add(path)
 
-    if not update_file:
-        raise Exception("No update file found!")
-    
+def copy_file(source_path, target_path, expected_sha, created, chunk_size=CHUNK_SIZE):
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    sha256 = hashlib.sha256()
+    _make_dirs(target_path.rpartition("/")[0], created)
+    with open(source_path, "rb") as source, open(target_path, "wb") as target:
+        while True:
+            n = source.readinto(buffer)
+            if not n:
+                break
+            sha256.update(view[:n])
+            target.write(view[:n])
+            yield 0
+    if binascii.hexlify(sha256.digest()).decode() != expected_sha:
+        raise Exception("Installed file changed: " + source_path)
+
+def extract_update(update_file, slot, only=None, chunk_size=CHUNK_SIZE):
+    """
+    Extracts the archive into slot in a single pass over its members. File data is
+    copied through one reusable buffer, so the peak heap does not depend on file
+    sizes. With a set of paths in only, every other file member is skipped. Patches
+    are extracted to PATCH_DIR for apply_patches(). A step generator, see run_steps().
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    created = set()
     with tarfile.open(update_file, "r:gz") as tar:
-        members = tar.getmembers()
-        for member in members:
-            target_path = member.name
-            parent_dir = "/".join(target_path.split("/")[:-1])
-            if parent_dir and not os.path.exists(parent_dir):
-                parts = parent_dir.split("/")
-                for i in range(1, len(parts)+1):
-                    subpath = "/".join(parts[:i])
-                    if subpath and not os.path.exists(subpath):
-                        os.mkdir(subpath)
+        for member in tar:
+            name = member.name.rstrip("/")
+            if name.startswith("./"):
+                name = name[2:]
+            if not name or name == ".":
+                continue
+
             f = tar.extractfile(member)
-            if f:
-                with open(target_path, "wb") as out_f:
-                    out_f.write(f.read())
+            if f is None:
+                if only is None:
+                    _make_dirs(slot + "/" + name, created)
+                continue
+            if name.startswith(PATCH_PREFIX):
+                if only is not None and name[len(PATCH_PREFIX):] not in only:
+                    continue
+                target_path = PATCH_DIR + name
+            elif only is not None and name not in only:
+                continue
             else:
-                if not os.path.exists(target_path):
-                    os.mkdir(target_path)
-    
-    os.remove("main.py")
-    os.rename("main_NEW.py", "main.py")
-    machine.reset()
+                target_path = slot_path(slot, name)
 
-if __name__ == "__main__":
+            _make_dirs(target_path.rpartition("/")[0], created)
+            with open(target_path, "wb") as out_f:
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    out_f.write(view[:n])
+                    yield 0
+
+def apply_patch(old_path, patch_path, new_path, expected_sha, chunk_size=CHUNK_SIZE):
+    """
+    Rebuilds a file from its old content and a patch. The result is streamed into
+    new_path and hashed on the way; a result that does not verify is removed.
+    A step generator, see run_steps().
+    """
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    sha256 = hashlib.sha256()
+    with open(patch_path, "rb") as patch, open(old_path, "rb") as old, open(new_path, "wb") as out:
+        if patch.read(len(PATCH_MAGIC)) != PATCH_MAGIC:
+            raise Exception("Invalid patch for " + new_path)
+        while True:
+            op = patch.read(1)
+            if op == PATCH_END:
+                break
+            if op == PATCH_COPY:
+                offset, length = struct.unpack("<II", patch.read(8))
+                old.seek(offset)
+                source = old
+            elif op == PATCH_INSERT:
+                length = struct.unpack("<I", patch.read(4))[0]
+                source = patch
+            else:
+                raise Exception("Invalid patch for " + new_path)
+
+            while length:
+                n = source.readinto(view[:min(length, chunk_size)])
+                if not n:
+                    raise Exception("Truncated patch for " + new_path)
+                sha256.update(view[:n])
+                out.write(view[:n])
+                length -= n
+                yield 0
+
+    if binascii.hexlify(sha256.digest()).decode() != expected_sha:
+        os.remove(new_path)
+        raise Exception("Patch verification failed for " + new_path)
+
+def apply_patches(manifest, changed, active, staging):
+    created = set()
+    for name in changed:
+        patch_path = PATCH_DIR + PATCH_PREFIX + name
+        try:
+            os.stat(patch_path)
+        except OSError:
+            continue
+        new_path = slot_path(staging, name)
+        _make_dirs(new_path.rpartition("/")[0], created)
+        yield from apply_patch(find_installed(active, name), patch_path, new_path, manifest["files"][name]["sha256"])
+        os.remove(patch_path)
+
+def find_update_file():
+    for f in os.listdir("/updates"):
+        if f.endswith(".tar.gz"):
+            return "/updates/" + f
+    raise Exception("No update file found!")
+
+def move_state_files(active):
+    # Versions before the state files moved to the root kept them inside their slot
+    if not active:
+        return
+    for name in STATE_FILES:
+        try:
+            os.stat("/" + name)
+        except OSError:
+            try:
+                os.rename(active + "/" + name, "/" + name)
+            except OSError:
+                pass
+
+def stage_update(update_file):
+    """
+    Builds the complete new version in the inactive slot while the running one stays
+    untouched. Unchanged files are copied over from the active slot, so only the
+    changed ones come from the archive. A step generator (see run_steps()) that
+    returns the staged slot.
+    """
+    active = get_active_slot()
+    move_state_files(active)
+    staging = SLOTS[1] if active == SLOTS[0] else SLOTS[0]
     try:
-        main()
+        shutil.rmtree(staging)
+    except OSError:
+        pass
+    os.mkdir(staging)
+
+    manifest = load_json(UPDATE_MANIFEST_PATH)
+    installed = load_json(active + "/" + MANIFEST_NAME)
+    if manifest is not None and installed is not None:
+        changed = get_changes(manifest, installed)
+        only = set(changed)
+        created = set()
+        try:
+            for name, entry in manifest["files"].items():
+                if name not in only:
+                    yield from copy_file(find_installed(active, name), slot_path(staging, name), entry["sha256"], created)
+            yield from extract_update(update_file, staging, only)
+            yield from apply_patches(manifest, changed, active, staging)
+            # A module that switched between .py and .mpy may not be in a delta archive
+            for name in manifest["files"]:
+                os.stat(slot_path(staging, name))
+        except Exception:
+            # The installed files do not match their manifest, so the next download
+            # has to be the full archive
+            os.remove(active + "/" + MANIFEST_NAME)
+            raise
+    else:
+        yield from extract_update(update_file, staging, None if manifest is None else set(manifest["files"]))
+
+    if manifest is not None:
+        save_json(staging + "/" + MANIFEST_NAME, manifest)
+    return staging
+
+def activate_slot(slot):
+    """Switches the next boot to slot. The switch is a single rename of the boot state."""
+    # boot.py picks the slot, so the staged version of it has to be at the root first
+    try:
+        with open(slot + "/boot.py", "rb") as f:
+            boot = f.read()
+        with open("/boot.py.tmp", "wb") as f:
+            f.write(boot)
+        os.rename("/boot.py.tmp", "/boot.py")
+    except OSError as e:
+        print(e)
+
+    save_json(BOOT_STATE_PATH, {"active": slot, "previous": get_active_slot(), "pending": True, "attempts": 0})
+
+def restore_root():
+    # Undoes the renames of the old install procedure, which started the updater as main.py
+    try:
+        os.stat("/main_OLD.py")
+    except OSError:
+        return
+    os.rename("/main.py", "/updater.py")
+    os.rename("/main_OLD.py", "/main.py")
+
+def main():
+    try:
+        slot = run_steps(stage_update(find_update_file()))
+        restore_root()
+        activate_slot(slot)
     except Exception as e:
+        # The running version was never touched, so it simply starts again
         print(e)
-        machine.deepsleep()
\ No newline at end of file
+        restore_root()
+    machine.reset()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Serves a folder over HTTP with Range support and drops connections on
+purpose, to exercise the resumable OTA download on a bench.
+
+    python tools/flaky_http_server.py dist/v1.2.0 --port 8000 --drop-after 50000
+
+Each response body is cut off after a random number of bytes up to
+--drop-after, with probability --drop-rate. With --only, only files whose
+name ends with that suffix (e.g. .tar.gz) are cut off.
+"""
+
+import argparse, http.server, os, random, re
+
+
+class FlakyHandler(http.server.SimpleHTTPRequestHandler):
+    drop_after = 50000
+    drop_rate = 0.5
+    only = ""
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            return super().do_GET()
+
+        with open(path, "rb") as f:
+            data = f.read()
+        start = 0
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        body = data[start:]
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        if path.endswith(self.only) and random.random() < self.drop_rate:
+            cut = random.randint(0, min(len(body), self.drop_after))
+            self.log_message("dropping after %d of %d bytes", cut, len(body))
+            self.wfile.write(body[:cut])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--drop-after", type=int, default=FlakyHandler.drop_after)
+    parser.add_argument("--drop-rate", type=float, default=FlakyHandler.drop_rate)
+    parser.add_argument("--only", default=FlakyHandler.only)
+    args = parser.parse_args()
+
+    FlakyHandler.drop_after = args.drop_after
+    FlakyHandler.drop_rate = args.drop_rate
+    FlakyHandler.only = args.only
+    os.chdir(args.directory)
+    http.server.ThreadingHTTPServer(("", args.port), FlakyHandler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
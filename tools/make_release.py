@@ -0,0 +1,242 @@
+"""
+Builds the release assets for an OTA update from the src folder.
+
+    python tools/make_release.py v1.2.0 --previous dist/v1.1.0/manifest.json --out dist/v1.2.0
+
+Writes the full tarball with its .sha256, one delta tarball per previous
+manifest (holding only the files that changed since that version) and
+manifest.json, which lists the hash and size of every file. Upload all of
+them as assets of the GitHub release tagged with the version.
+
+If the previous release's full tarball lies next to its manifest, a changed
+file is shipped as a binary patch against its old content whenever the
+compressed patch is smaller than the compressed file.
+
+With mpy-cross available (--mpy-cross, default: from PATH, see
+tools/requirements.txt) every module is also compiled to .mpy. The archives
+then come in two forms that hold one file per module: the plain ones with
+the .py sources and the *_mpy ones with the bytecode. The manifest records the
+bytecode version, so a device downloads the bytecode form only if its firmware
+can load it. Use the mpy-cross that matches the firmware.
+"""
+
+import argparse, hashlib, io, json, os, shutil, struct, subprocess, tarfile, tempfile, zlib
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+# The application is shipped as main_NEW.py because main.py runs the updater during an install
+RENAMES = {"main.py": "main_NEW.py"}
+EXCLUDED_DIRS = {"__pycache__"}
+# The updater runs as main.py during an install, so there is no old updater.py to patch
+UNPATCHABLE = {"updater.py"}
+# MicroPython runs these as scripts and the old install procedure renames updater.py,
+# so they always stay source
+NOT_COMPILED = {"main_NEW.py", "boot.py", "updater.py"}
+
+# Patch format, see PATCH_* in src/updater.py
+PATCH_PREFIX = ".patch/"
+PATCH_MAGIC = b"OTAP"
+PATCH_END = b"\x00"
+PATCH_COPY = b"\x01"
+PATCH_INSERT = b"\x02"
+PATCH_BLOCK = 16
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def collect_files(src_dir, version):
+    files = {}
+    for root, dirs, names in os.walk(src_dir):
+        dirs[:] = sorted(d for d in dirs if d not in EXCLUDED_DIRS)
+        for name in sorted(names):
+            path = os.path.relpath(os.path.join(root, name), src_dir).replace(os.sep, "/")
+            with open(os.path.join(root, name), "rb") as f:
+                files[RENAMES.get(path, path)] = f.read()
+    files["version"] = version.encode()
+    return files
+
+
+def compile_mpy(files, mpy_cross):
+    """Adds a .mpy next to every compilable module and returns the bytecode version info."""
+    info = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in sorted(files):
+            if not name.endswith(".py") or name in NOT_COMPILED:
+                continue
+            source = os.path.join(tmp, "module.py")
+            target = os.path.join(tmp, "module.mpy")
+            with open(source, "wb") as f:
+                f.write(files[name])
+            # -s keeps the real file name in tracebacks
+            subprocess.run([mpy_cross, "-s", name, "-o", target, source], check=True)
+            with open(target, "rb") as f:
+                data = f.read()
+
+            # Header: b"M", bytecode version, native architecture flags, small int bits.
+            # Modules are compiled without -march, so only the version has to match
+            if data[:1] != b"M" or data[2] >> 2:
+                raise SystemExit(f"{mpy_cross} produced no bytecode-only .mpy for {name}")
+            module_info = {"version": data[1]}
+            if info is not None and module_info != info:
+                raise SystemExit(f"Mixed bytecode versions: {module_info} != {info}")
+            info = module_info
+            files[name[:-3] + ".mpy"] = data
+    return info
+
+
+def get_form(files, mpy):
+    """Returns the paths of one archive form: bytecode where compiled, or the sources only."""
+    if mpy:
+        return [path for path in files if not (path.endswith(".py") and path[:-3] + ".mpy" in files)]
+    return [path for path in files if not path.endswith(".mpy")]
+
+
+def read_archive(path):
+    files = {}
+    with tarfile.open(path, "r:gz") as tar:
+        for member in tar:
+            if member.isfile():
+                files[member.name] = tar.extractfile(member).read()
+    return files
+
+
+def make_patch(old, new):
+    """Encodes new as copy/insert opcodes against old using aligned block matches."""
+    blocks = {}
+    for offset in range(0, len(old) - PATCH_BLOCK + 1, PATCH_BLOCK):
+        blocks.setdefault(old[offset:offset + PATCH_BLOCK], offset)
+
+    out = bytearray(PATCH_MAGIC)
+    literal_start = i = 0
+    while i <= len(new) - PATCH_BLOCK:
+        offset = blocks.get(new[i:i + PATCH_BLOCK])
+        if offset is None:
+            i += 1
+            continue
+
+        # Grow the match backwards into the pending literal and then forwards
+        start = i
+        while start > literal_start and offset > 0 and old[offset - 1] == new[start - 1]:
+            start -= 1
+            offset -= 1
+        end = i + PATCH_BLOCK
+        while end < len(new) and offset + end - start < len(old) and old[offset + end - start] == new[end]:
+            end += 1
+
+        if start > literal_start:
+            out += PATCH_INSERT + struct.pack("<I", start - literal_start) + new[literal_start:start]
+        out += PATCH_COPY + struct.pack("<II", offset, end - start)
+        literal_start = i = end
+
+    if literal_start < len(new):
+        out += PATCH_INSERT + struct.pack("<I", len(new) - literal_start) + new[literal_start:]
+    out += PATCH_END
+    return bytes(out)
+
+
+def apply_patch(old, patch):
+    # Host-side check that every patch rebuilds its file
+    new = bytearray()
+    i = len(PATCH_MAGIC)
+    while patch[i:i + 1] != PATCH_END:
+        op = patch[i:i + 1]
+        if op == PATCH_COPY:
+            offset, length = struct.unpack_from("<II", patch, i + 1)
+            new += old[offset:offset + length]
+            i += 9
+        else:
+            length = struct.unpack_from("<I", patch, i + 1)[0]
+            new += patch[i + 5:i + 5 + length]
+            i += 5 + length
+    return bytes(new)
+
+
+def write_archive(path, files, paths, old_files=None):
+    patched = 0
+    with tarfile.open(path, "w:gz") as tar:
+        for name in sorted(paths):
+            data = files[name]
+            old = (old_files or {}).get(name)
+            if old is not None and name not in UNPATCHABLE:
+                patch = make_patch(old, data)
+                assert apply_patch(old, patch) == data
+                if len(zlib.compress(patch, 9)) < len(zlib.compress(data, 9)):
+                    name, data = PATCH_PREFIX + name, patch
+                    patched += 1
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    with open(path, "rb") as f:
+        data = f.read()
+    return {"name": os.path.basename(path), "sha256": sha256(data), "size": len(data)}, patched
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("version")
+    parser.add_argument("--src", default=SRC_DIR)
+    parser.add_argument("--out", default="dist")
+    parser.add_argument("--previous", action="append", default=[],
+                        help="manifest.json of an earlier release to build a delta archive against")
+    parser.add_argument("--mpy-cross", default=shutil.which("mpy-cross"),
+                        help="mpy-cross executable matching the device firmware")
+    args = parser.parse_args()
+
+    os.makedirs(args.out, exist_ok=True)
+    files = collect_files(args.src, args.version)
+    mpy = None
+    if args.mpy_cross:
+        mpy = compile_mpy(files, args.mpy_cross)
+        print(f"mpy: bytecode version {mpy['version']}")
+    else:
+        print("mpy-cross not found, shipping source only")
+    entries = {path: {"sha256": sha256(data), "size": len(data)} for path, data in files.items()}
+
+    # "" is the source form every firmware can install, "_mpy" the bytecode form
+    forms = {"": get_form(files, False)}
+    if mpy is not None:
+        forms["_mpy"] = get_form(files, True)
+
+    previous_manifests = []
+    for previous_path in args.previous:
+        with open(previous_path) as f:
+            previous_manifests.append((os.path.dirname(previous_path), json.load(f)))
+
+    archives = {}
+    for suffix, paths in forms.items():
+        full, _ = write_archive(os.path.join(args.out, f"update-{args.version}{suffix}.tar.gz"), files, paths)
+        archives["full" + suffix] = full
+        print(f"full{suffix}: {len(paths)} files, {full['size']} bytes")
+
+        deltas = {}
+        for previous_dir, previous in previous_manifests:
+            changed = [
+                path for path in paths
+                if previous["files"].get(path, {}).get("sha256") != entries[path]["sha256"]
+            ]
+            old_files = None
+            previous_full = previous["archives"].get("full" + suffix)
+            if previous_full is not None:
+                previous_archive = os.path.join(previous_dir, previous_full["name"])
+                if os.path.exists(previous_archive):
+                    old_files = read_archive(previous_archive)
+            name = f"delta-{previous['version']}-{args.version}{suffix}.tar.gz"
+            delta, patched = write_archive(os.path.join(args.out, name), files, changed, old_files)
+            deltas[previous["version"]] = delta
+            print(f"{previous['version']}{suffix}: {len(changed)} changed ({patched} patched), {delta['size']} bytes")
+        archives["deltas" + suffix] = deltas
+
+    # Releases without a manifest were installed from the checksum of the full source archive
+    with open(os.path.join(args.out, f"update-{args.version}.sha256"), "w") as f:
+        f.write(f"{archives['full']['sha256']}  {archives['full']['name']}\n")
+
+    manifest = {"version": args.version, "files": entries, "archives": archives}
+    if mpy is not None:
+        manifest["mpy"] = mpy
+    with open(os.path.join(args.out, "manifest.json"), "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+
+
+if __name__ == "__main__":
+    main()
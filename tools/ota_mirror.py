@@ -0,0 +1,154 @@
+"""
+Site-local OTA mirror with content-addressed storage.
+
+    python tools/ota_mirror.py sync --repo smolinde/ota-test --store mirror
+    python tools/ota_mirror.py import dist/v1.2.0 --version v1.2.0 --store mirror
+    python tools/ota_mirror.py serve --store mirror --port 8000
+
+sync downloads the assets of the latest GitHub release once for the whole
+site, import adds a locally built release (tools/make_release.py). Every
+asset is stored as sha256/<hash>, so an asset shared by several releases is
+stored and downloaded once. latest.json maps the release's asset names to
+their hashes. serve answers latest.json with an ETag and serves the blobs
+with Range support for resumed downloads. Point OTA_MIRROR_URL in
+src/updater.py at the server.
+"""
+
+import argparse, hashlib, http.server, json, os, re, tempfile, urllib.request
+
+
+def store_blob(store, source):
+    """Copies a file object into the store and returns its SHA-256."""
+    os.makedirs(os.path.join(store, "sha256"), exist_ok=True)
+    sha256 = hashlib.sha256()
+    with tempfile.NamedTemporaryFile(dir=store, delete=False) as tmp:
+        for chunk in iter(lambda: source.read(65536), b""):
+            sha256.update(chunk)
+            tmp.write(chunk)
+    digest = sha256.hexdigest()
+    os.replace(tmp.name, os.path.join(store, "sha256", digest))
+    return digest
+
+
+def write_latest(store, tag_name, assets):
+    with open(os.path.join(store, "latest.json.tmp"), "w") as f:
+        json.dump({"tag_name": tag_name, "assets": assets}, f, separators=(",", ":"))
+    os.replace(os.path.join(store, "latest.json.tmp"), os.path.join(store, "latest.json"))
+    print(f"{tag_name}: {len(assets)} assets")
+
+
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def sync(args):
+    request = urllib.request.Request(
+        f"https://api.github.com/repos/{args.repo}/releases/latest",
+        headers={"Accept": "application/vnd.github+json", "User-Agent": "ota-mirror"}
+    )
+    with urllib.request.urlopen(request) as response:
+        release = json.load(response)
+
+    # Download URLs of GitHub assets never change their content, so each is fetched once
+    known = load_json(os.path.join(args.store, "downloads.json"), {})
+    assets = {}
+    for asset in release["assets"]:
+        url = asset["browser_download_url"]
+        digest = known.get(url)
+        if digest is None or not os.path.exists(os.path.join(args.store, "sha256", digest)):
+            print("downloading", asset["name"])
+            with urllib.request.urlopen(urllib.request.Request(url, headers={"User-Agent": "ota-mirror"})) as response:
+                digest = store_blob(args.store, response)
+            known[url] = digest
+        assets[asset["name"]] = digest
+
+    with open(os.path.join(args.store, "downloads.json"), "w") as f:
+        json.dump(known, f)
+    write_latest(args.store, str(release["tag_name"]), assets)
+
+
+def import_release(args):
+    assets = {}
+    for name in sorted(os.listdir(args.directory)):
+        with open(os.path.join(args.directory, name), "rb") as f:
+            assets[name] = store_blob(args.store, f)
+    write_latest(args.store, args.version, assets)
+
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    store = "mirror"
+
+    def do_GET(self):
+        if self.path == "/latest.json":
+            path = os.path.join(self.store, "latest.json")
+        elif re.fullmatch(r"/sha256/[0-9a-f]{64}", self.path):
+            path = os.path.join(self.store, self.path[1:])
+        else:
+            return self.send_error(404)
+        if not os.path.isfile(path):
+            return self.send_error(404)
+
+        with open(path, "rb") as f:
+            data = f.read()
+        etag = '"' + hashlib.sha256(data).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+
+def serve(args):
+    MirrorHandler.store = args.store
+    http.server.ThreadingHTTPServer(("", args.port), MirrorHandler).serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    command = commands.add_parser("sync", help="mirror the latest GitHub release")
+    command.add_argument("--repo", default="smolinde/ota-test")
+    command.add_argument("--store", default="mirror")
+    command.set_defaults(run=sync)
+
+    command = commands.add_parser("import", help="publish a release built by make_release.py")
+    command.add_argument("directory")
+    command.add_argument("--version", required=True)
+    command.add_argument("--store", default="mirror")
+    command.set_defaults(run=import_release)
+
+    command = commands.add_parser("serve", help="serve the mirror to the devices")
+    command.add_argument("--store", default="mirror")
+    command.add_argument("--port", type=int, default=8000)
+    command.set_defaults(run=serve)
+
+    args = parser.parse_args()
+    os.makedirs(args.store, exist_ok=True)
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()